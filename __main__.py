@@ -13,8 +13,9 @@ sys.path.insert(0, os.path.dirname(THISDIR))
 # Now we can import it
 import notes
 
-# Launch!
-app = QtWidgets.QApplication([])
-w = notes.Notes(None)
-w.show()
-app.exec_()
+# Launch! (but not in processes that are spawned to parse notes)
+if __name__ == '__main__':
+    app = QtWidgets.QApplication([])
+    w = notes.Notes(None)
+    w.show()
+    app.exec_()
@@ -19,6 +19,8 @@ from qtpy import QtCore, QtGui, QtWidgets
 from .noteproxy import Note
 from .notecollection import NoteCollection
 from .notedisplay import NotesContainer
+from .watcher import FolderWatcher
+from . import backup
 
 
 # Taken from pyzolib
@@ -109,6 +111,12 @@ class Settings(object):
                                 ('computername', gethostname()),
                                 ('embedded', (self._filename is None)),
                                 ('geometry', None),
+                                ('appendonly', False),
+                                ('rankedsearch', False),
+                                ('index', 'memory'),
+                                ('segmentsize', 2**20),
+                                ('backupfolder', None),
+                                ('backupcompression', 'gz'),
                                 ('clr_note', '#268bd2'),
                                 ('clr_task', '#cb4b16'),
                                 ('clr_idea', '#859900'),
@@ -194,12 +202,9 @@ class Notes(QtWidgets.QWidget):
         menu.triggered.connect(self.onTagsMenuTriggered)
         menu.aboutToShow.connect(self.onTagsMenuAboutToShow)
         
-        # Create timer to check for updates
-        self._timer = QtCore.QTimer(self)
-        self._timer.setInterval(2000) # ms
-        self._timer.setSingleShot(False)
-        self._timer.timeout.connect(self.checkUpToDate)
-        self._timer.start()
+        # The watcher for the note folder checks for updates
+        self._watcher = None
+        self._statusGeneration = -1
         
         # Layout
         layout = QtWidgets.QVBoxLayout(self)
@@ -242,16 +247,33 @@ class Notes(QtWidgets.QWidget):
         Create a collection object that manages all note files in that folder
         also set the collection on the note container object.
         """
+        # Stop watching, and write all saved notes of the current collection
+        # first, so that the new collection (maybe of the same folder) sees them.
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+        self._collection.saveCache()
+        self._collection.close()
         # Try getting collection, use dummy otherwise
         errtext = ''
         try:
-            collection = NoteCollection.fromFolder(folder, config['computername'])
+            cacheDir = appdata_dir('notes_txt')
+            collection = NoteCollection.fromFolder(folder, config['computername'],
+                                                   cacheDir, config['appendonly'],
+                                                   background=True,
+                                                   index=config['index'])
         except Exception as err:
             errtext = str(err)
             collection = NoteCollection()
         # Set collection
         self._collection = collection
         self._container.setCollection(collection)
+        self._statusGeneration = -1
+        self.updateStatus()
+        # Watch for changes
+        if not errtext:
+            self._watcher = FolderWatcher(folder, self)
+            self._watcher.changed.connect(self.checkUpToDate)
         # Set error text?
         if errtext:
             self._container._stopper.setText(errtext)
@@ -270,6 +292,7 @@ class Notes(QtWidgets.QWidget):
         menu.addSeparator()
         menu.addAction('Consolidate ...')
         menu.addAction('Backup ...')
+        menu.addAction('Restore backup ...')
         menu.addSeparator()
         for folder in config['notefolders']:
             action = menu.addAction('Use %s' % folder)
@@ -339,29 +362,74 @@ class Notes(QtWidgets.QWidget):
             text += '\n\nProceed with consolidation?'
             res = QtWidgets.QMessageBox.question(self, 'Consolidate notes', text)
             if res == QtWidgets.QMessageBox.Yes:
-                # Clear all
-                for fileproxy in self._collection._fileProxies:
-                    with open(fileproxy._filename, 'wb') as f:
-                        pass
-                # Consolidate
-                filename =  self._collection._fileProxies[0]._filename
-                self._collection.save_consolidated(filename)
-                # Exit
-                QtWidgets.QMessageBox.information(self, 'Consolidate notes', 'The app will now close, please restart.')
-                sys.exit()
+                # Stop writing and watching; the other files are cleared
+                # only after the consolidated file is in place.
+                self._collection.close()
+                if self._watcher is not None:
+                    self._watcher.close()
+                    self._watcher = None
+                self.runConsolidator(self._collection.consolidator())
+                # Load the consolidated notes
+                self.setNoteFolder(config['notefolder'])
         
-        elif 'backup' in cmd:
-            s = QtWidgets.QFileDialog.getSaveFileName(self, 
-                'Select folder to backup (consolidated) notes', os.path.expanduser('~'))
+        elif 'restore' in cmd:
+            folder = QtWidgets.QFileDialog.getExistingDirectory(self,
+                'Select backup folder', config['backupfolder'] or os.path.expanduser('~'))
+            points = backup.loadManifest(folder)['points'] if folder else []
+            if not points:
+                return
+            items = ['%s (%i notes)' % (p['time'], p['total']) for p in reversed(points)]
+            item, ok = QtWidgets.QInputDialog.getItem(self, 'Restore backup',
+                'Select the backup to restore:', items, 0, False)
+            if not ok:
+                return
+            s = QtWidgets.QFileDialog.getSaveFileName(self,
+                'Select file to restore the notes to', os.path.expanduser('~'))
             if isinstance(s, tuple):
                 s = s[0]
             if s:
-                self._collection.save_consolidated(s)
+                n = backup.restore(folder, s, len(points) - 1 - items.index(item))
+                QtWidgets.QMessageBox.information(self, 'Restore backup',
+                    'Restored %i notes to %s' % (n, s))
+        
+        elif 'backup' in cmd:
+            folder = QtWidgets.QFileDialog.getExistingDirectory(self,
+                'Select folder to backup notes to',
+                config['backupfolder'] or os.path.expanduser('~'))
+            if folder:
+                config['backupfolder'] = folder
+                point = backup.backup(self._collection, folder, config['backupcompression'])
+                QtWidgets.QMessageBox.information(self, 'Backup',
+                    'Backed up %i new or changed notes (%i removed, %i in total).' %
+                    (point['changed'], len(point['removed']), point['total']))
         
         # Save
         saveConfig()
     
     
+    def runConsolidator(self, consolidator):
+        """ Run the given Consolidator, showing its progress in a dialog.
+        """
+        dialog = QtWidgets.QProgressDialog('Consolidating notes ...', None, 0, 1000, self)
+        dialog.setWindowTitle('Consolidate notes')
+        dialog.setMinimumDuration(0)
+        timer = QtCore.QTimer(dialog)
+        timer.setInterval(50) # ms
+        def check():
+            dialog.setValue(int(1000 * consolidator.progress))
+            if consolidator.done:
+                timer.stop()
+                dialog.accept()
+        timer.timeout.connect(check)
+        consolidator.start()
+        timer.start()
+        dialog.exec_()
+        consolidator.wait()
+        if consolidator.error is not None:
+            QtWidgets.QMessageBox.warning(self, 'Consolidate notes',
+                'Could not consolidate notes: %s' % consolidator.error)
+    
+    
     def onTagsMenuAboutToShow(self):
         # Get selection and tags
         prefix, tags, words = self._container.currentSelection()
@@ -414,27 +482,45 @@ class Notes(QtWidgets.QWidget):
         g = self.geometry()
         config['geometry'] = g.left(), g.top(), g.width(), g.height()
         saveConfig()
+        self._collection.saveCache()
+        self._collection.close()
+        if self._watcher is not None:
+            self._watcher.close()
         super().closeEvent(event)
     
     
-    def checkUpToDate(self):
-        
-        # Status
+    def updateStatus(self):
+        # Only count if the collection has changed
+        if self._statusGeneration == self._collection.generation:
+            return
+        self._statusGeneration = self._collection.generation
         n_notes = len(self._collection)
         n_hidden = len([n for n in self._collection if n.prefix == '.'])
         self._statusLabel.setText('%i notes (+ %i hidden)' % (n_notes - n_hidden, n_hidden))
+    
+    
+    def checkUpToDate(self, filenames=None):
+        """ Called by the watcher when files in the note folder have
+        changed (filenames is None if it is not known which).
+        """
+        
+        # Remove old versions of notes from our file when there are many,
+        # and start a new segment when it is too large
+        if not self._container.hasNotesExpanded():
+            self._collection.compact(0.5)
+            self._collection.rollover(config['segmentsize'])
         
         # Update from the outside
-        updatedFiles = self._collection.update()
-        if updatedFiles:
-            if not self._container.hasNotesExpanded():
-                self._container.showNotes() # Update silently
-            else:
-                filestr = '\n'.join([repr(f) for f in updatedFiles])
-                QtWidgets.QMessageBox.warning(self, "Notes updated externally",
-                    "Notes have been updated externally in\n%s\n\n" % filestr +
-                    "Saving your notes now may override these updates " +
-                    "if they're defined in the same file." )
+        changes = self._collection.update(filenames)
+        self.updateStatus()
+        # Update only the notes that changed, leaving notes being edited alone
+        conflicts = self._container.applyChanges(changes)
+        if conflicts:
+            filestr = '\n'.join([repr(f) for f in changes.files])
+            QtWidgets.QMessageBox.warning(self, "Notes updated externally",
+                "Notes that you are editing have been updated externally in\n%s\n\n" % filestr +
+                "Saving your notes now may override these updates " +
+                "if they're defined in the same file." )
 
 
 
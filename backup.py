@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" notes.backup
+This module implements incremental backups of a collection. A backup
+folder contains a manifest and compressed chunks. Each backup adds a
+point to the manifest, and a chunk with only the notes that are new or
+changed since the previous backup (in the format of a note file). The
+manifest also lists the notes that were removed, and keeps the version
+(modified date) of each note that is backed up, so that any backup point
+can be restored.
+"""
+
+import os
+import gzip
+import lzma
+import json
+import datetime
+
+from .consolidate import readEntries, entryInfo
+from .headercodec import formatModified
+
+
+MANIFEST = 'manifest.json'
+
+# The modules to compress chunks with, by file extension
+COMPRESSORS = {'gz': gzip, 'xz': lzma}
+
+
+def loadManifest(folder):
+    """ Load the manifest of the given backup folder. Returns a dict with
+    'points' (a list of dicts, oldest first) and 'versions' (id ->
+    modified string of the notes in the latest point).
+    """
+    filename = os.path.join(folder, MANIFEST)
+    if not os.path.isfile(filename):
+        return dict(points=[], versions={})
+    with open(filename, 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def _saveManifest(folder, manifest):
+    # Write to a temporary file first, so the manifest is never corrupt
+    filename = os.path.join(folder, MANIFEST)
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(json.dumps(manifest).encode('utf-8'))
+    os.replace(filename + '.tmp', filename)
+
+
+def backup(collection, folder, compression='gz'):
+    """ Backup the notes in the given collection to the given folder.
+    Only notes that are new or changed since the previous backup in this
+    folder are written, to a chunk compressed with gzip ('gz') or lzma
+    ('xz'). Returns the new point in the manifest.
+    """
+    if compression not in COMPRESSORS:
+        raise ValueError('Invalid compression %r' % compression)
+    os.makedirs(folder, exist_ok=True)
+    manifest = loadManifest(folder)
+    versions = manifest['versions']
+
+    # Compare with the backed up versions
+    notes = {note.id: note for note in collection}
+    changed = [note for id, note in notes.items()
+               if versions.get(id, None) != note.modifiedStr]
+    removed = [id for id in versions if id not in notes]
+
+    # Write the chunk
+    now = datetime.datetime.now()
+    chunk = None
+    if changed:
+        chunk = 'chunk-%04i-%s.txt.%s' % (len(manifest['points']) + 1,
+                                          now.strftime('%Y%m%d%H%M%S'), compression)
+        filename = os.path.join(folder, chunk)
+        with COMPRESSORS[compression].open(filename + '.tmp', 'wb') as f:
+            for note in changed:
+                f.write(('\n---- %s\n' % note._header).encode('utf-8'))
+                f.write(note.text.encode('utf-8'))
+        os.replace(filename + '.tmp', filename)
+
+    # Update the manifest
+    for note in changed:
+        versions[note.id] = note.modifiedStr
+    for id in removed:
+        del versions[id]
+    point = dict(time=formatModified(now), chunk=chunk, changed=len(changed),
+                 removed=removed, total=len(versions))
+    manifest['points'].append(point)
+    _saveManifest(folder, manifest)
+    return point
+
+
+def restore(folder, filename, point=-1):
+    """ Restore the notes of the given backup point (an index in the list
+    of points in the manifest, the latest by default) to a note file with
+    the given name. Returns the number of notes written.
+    """
+    points = loadManifest(folder)['points']
+    points = points[:len(points) + point + 1 if point < 0 else point + 1]
+
+    # Find the chunk and position of each note at that point, in one pass
+    # over the chunks (decompressing as a stream).
+    where = {}  # id -> (chunk index, entry index)
+    for i, p in enumerate(points):
+        if p['chunk']:
+            for j, (header, text) in enumerate(_iterChunk(folder, p['chunk'])):
+                info = entryInfo(header, text)
+                if info is not None:
+                    where[info[0]] = i, j
+        for id in p['removed']:
+            where.pop(id, None)
+
+    # Write these notes, in the order in which they were backed up
+    wanted = set(where.values())
+    chunks = set(i for i, j in wanted)
+    count = 0
+    with open(filename + '.tmp', 'wb') as f:
+        for i, p in enumerate(points):
+            if i not in chunks:
+                continue
+            for j, (header, text) in enumerate(_iterChunk(folder, p['chunk'])):
+                if (i, j) in wanted:
+                    f.write(('\n---- %s\n' % header).encode('utf-8'))
+                    f.write(text + b'\n')
+                    count += 1
+    os.replace(filename + '.tmp', filename)
+    return count
+
+
+def _iterChunk(folder, chunk):
+    compressor = COMPRESSORS[chunk.rsplit('.', 1)[-1]]
+    with compressor.open(os.path.join(folder, chunk), 'rb') as f:
+        yield from readEntries(f)
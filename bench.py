@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+""" Micro-benchmarks for the notes package.
+Run with ``python bench.py [name ...]`` from the repository folder.
+"""
+
+import os
+import sys
+import time
+import random
+import datetime
+import shutil
+import tempfile
+import tracemalloc
+
+# Add notes package to sys.path
+THISDIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(THISDIR))
+
+from notes import headercodec, backup
+from notes.noteproxy import FileProxy
+from notes.notecollection import NoteCollection
+
+
+def timeit(func, *args):
+    t0 = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - t0, result
+
+
+def makeHeaders(n, ndays=300):
+    """ Create n headers like the app writes them.
+    """
+    t0 = datetime.datetime(2014, 1, 1)
+    headers = []
+    for i in range(n):
+        created = t0 + datetime.timedelta(random.randint(0, ndays))
+        modified = created + datetime.timedelta(0, random.randint(0, 86400))
+        headers.append('id:%040x, c:%s, m:%s' % (random.getrandbits(160),
+                       created.strftime('%Y-%m-%d'),
+                       modified.strftime('%Y-%m-%d %H:%M:%S')))
+    return headers
+
+
+def makeNotesFile(n, nwords=5000, ntags=200):
+    """ Create a temporary notes file with n synthetic notes. Words and
+    tags are drawn from a skewed distribution, like in real text.
+    """
+    words = ['w%i' % i for i in range(nwords)]
+    tags = ['#t%i' % i for i in range(ntags)]
+    filename = os.path.join(tempfile.gettempdir(), 'notes.bench.txt')
+    with open(filename, 'wb') as f:
+        for header in makeHeaders(n):
+            text = [random.choice(['', '! ', '? ', '.'])]
+            text += [tags[int(random.paretovariate(1)) % ntags]
+                     for i in range(random.randint(0, 3))]
+            text += [words[int(random.paretovariate(0.5)) % nwords]
+                     for i in range(random.randint(5, 60))]
+            f.write(('\n---- %s\n%s\n' % (header, ' '.join(text))).encode('utf-8'))
+    return filename
+
+
+def _oldParseHeader(header):
+    """ The per-note header parsing that was used before the header codec.
+    """
+    header = header.strip(' \t\n\r-:')
+    created = ''
+    modified = ''
+    id = None
+    for part in header.split(','):
+        key, colon, value = part.partition(':')
+        key, value = key.strip(), value.strip()
+        if key == 'id':
+            id = value
+        elif key in ('c', 'created'):
+            created = value
+        elif key in ('m', 'modified'):
+            modified = value
+        elif part:
+            created = part
+    result = [id]
+    for s in (created, modified):
+        dt = None
+        for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%Y%m%d']:
+            try:
+                dt = datetime.datetime.strptime(s, fmt)
+                break
+            except ValueError:
+                pass
+        result.append(dt)
+    return result
+
+
+def bench_headers(n=100000):
+    """ Parse the headers of a file with 100k notes.
+    """
+    headers = makeHeaders(n)
+    # Write and read back as a file, so that we time what getNotes sees
+    filename = os.path.join(tempfile.gettempdir(), 'notes.bench.txt')
+    with open(filename, 'wb') as f:
+        for header in headers:
+            f.write(('\n---- %s\nsome text\n' % header).encode('utf-8'))
+    with open(filename, 'rb') as f:
+        chunks = f.read().decode('utf-8').split('\n----')[1:]
+    headers = [chunk.split('\n', 1)[0].strip() for chunk in chunks]
+    os.remove(filename)
+
+    headercodec._dateTimeCache.clear()
+    t1, old = timeit(lambda: [_oldParseHeader(h) for h in headers])
+    t2, new = timeit(lambda: [(fields, headercodec.decodeModified(fields[3], fields[1]))
+                              for fields in headercodec.decodeHeaders(headers)])
+    for a, (fields, modified) in zip(old, new):
+        assert a == [fields[0], fields[1], modified[0]]
+    print('Parsing %i headers (created and modified):' % n)
+    print('  strptime loop: %0.3f s' % t1)
+    print('  header codec:  %0.3f s (%0.1f x faster)' % (t2, t1 / t2))
+
+
+def bench_vocabulary(n=100000):
+    """ Memory for the tags and words of 100k notes, with and without the
+    shared vocabulary of a collection.
+    """
+    filename = makeNotesFile(n)
+    print('Memory for %i notes with parsed tags and words:' % n)
+    for label, collection in [('separate tokens', None),
+                              ('shared vocabulary', NoteCollection())]:
+        tracemalloc.start()
+        notes = FileProxy(filename, collection=collection).getNotes()
+        for note in notes:
+            note.tags
+        mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        t, count = timeit(lambda: sum(1 for note in notes
+                                      if 'w1' in note.words and '#t1' in note.tags))
+        print('  %s: %0.1f MiB, query %0.1f ms' % (label, mem / 2**20, t * 1000))
+        del notes
+    os.remove(filename)
+
+
+def bench_query(n=100000):
+    """ Tag and word (prefix) queries on 100k notes, by scanning all
+    notes and with the inverted index.
+    """
+    filename = makeNotesFile(n)
+    collection = NoteCollection(filename)
+    collection.allTags()  # Parse all notes and build the index
+    print('Queries on %i notes:' % n)
+    for tags, words in [(['#t1'], []), (['#t1'], ['w2']), ([], ['w100']),
+                        (['#t150'], ['w3']), ([], ['w']), (['#t'], ['w4999'])]:
+        def scan():
+            return [note for note in collection.select()
+                    if all(any(t.startswith(tag) for t in note.tags)
+                           for tag in tags) and
+                    all(any(t.startswith((w, '#' + w))
+                            for t in note.words | note.tags) for w in words)]
+        t1, result = timeit(scan)
+        t2, result = timeit(collection.query, '', tags, words)
+        print('  %-20s %6i notes, scan %6.1f ms, index %6.1f ms' %
+              (' '.join(tags + words), len(result), t1 * 1000, t2 * 1000))
+    os.remove(filename)
+
+
+
+def bench_backup(n=100000, nchanged=100):
+    """ Daily backup of 100k notes of which 100 changed: a consolidated
+    copy versus an incremental compressed backup.
+    """
+    filename = makeNotesFile(n)
+    collection = NoteCollection(filename)
+    folder = tempfile.mkdtemp()
+    consolidated = os.path.join(folder, 'consolidated.txt')
+    backupFolder = os.path.join(folder, 'backup')
+    backup.backup(collection, backupFolder)  # Initial full backup
+    for note in random.sample(list(collection), nchanged):
+        note.setText(note.text + ' changed')
+        note.save(True)
+    t1, _ = timeit(collection.save_consolidated, consolidated)
+    t2, point = timeit(backup.backup, collection, backupFolder)
+    size1 = os.path.getsize(consolidated)
+    size2 = os.path.getsize(os.path.join(backupFolder, point['chunk']))
+    print('Backup of %i notes (%i changed):' % (n, nchanged))
+    print('  consolidated  %6.1f ms  %8i bytes' % (t1 * 1000, size1))
+    print('  incremental   %6.1f ms  %8i bytes' % (t2 * 1000, size2))
+    shutil.rmtree(folder)
+    os.remove(filename)
+
+
+def bench_snapshot(n=100000):
+    """ Load 100k notes and their tags and words, from the text file and
+    from a binary snapshot.
+    """
+    filename = makeNotesFile(n)
+    snapshot = filename + '.snapshot'
+    NoteCollection(filename).saveSnapshot(snapshot)
+    def loadText():
+        collection = NoteCollection(filename)
+        collection.allTags()  # Needs the tags and words of all notes
+        return collection
+    def loadSnapshot():
+        collection = NoteCollection.loadSnapshot(snapshot)
+        collection.allTags()
+        return collection
+    # Only one collection is alive at a time, so that both loads are
+    # equally affected by the garbage collector.
+    t1, n1 = timeit(lambda: len(loadText()))
+    t2, n2 = timeit(lambda: len(loadSnapshot()))
+    assert n1 == n2
+    print('Load %i notes with tags and words:' % n)
+    print('  text file  %6.1f ms  %8i bytes' % (t1 * 1000, os.path.getsize(filename)))
+    print('  snapshot   %6.1f ms  %8i bytes' % (t2 * 1000, os.path.getsize(snapshot)))
+    os.remove(snapshot)
+    os.remove(filename)
+
+
+def bench_sqlindex(n=100000):
+    """ Memory, indexing and queries for 100k notes, with the in-memory
+    index and the SQLite index (which is stored in a cache dir). Memory
+    is that of Python objects; building is timed while tracing it.
+    """
+    filename = makeNotesFile(n)
+    cacheDir = tempfile.mkdtemp()
+    queries = [(['#t1'], []), (['#t1'], ['w2']), ([], ['w100']), ([], ['w'])]
+    print('Index of %i notes:' % n)
+    for label, index in [('memory', 'memory'), ('sqlite', 'sqlite'),
+                         ('sqlite again', 'sqlite')]:
+        tracemalloc.start()
+        collection = NoteCollection(filename, cacheDir=cacheDir, index=index)
+        t, tags = timeit(collection.allTags)  # Builds the index
+        mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        times = []
+        for tags, words in queries:
+            times.append(timeit(collection.query, '', tags, words)[0])
+        print('  %-12s %6.1f MiB, build %6.1f ms, queries %s ms' %
+              (label, mem / 2**20, t * 1000, ' '.join('%0.1f' % (t * 1000) for t in times)))
+        collection.close()
+        del collection
+    shutil.rmtree(cacheDir)
+    os.remove(filename)
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or [name[6:] for name in sorted(globals())
+                             if name.startswith('bench_')]
+    for name in names:
+        globals()['bench_' + name]()
+        print()
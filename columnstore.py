@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" notes.columnstore
+This module implements a columnar store for the metadata of the notes in
+a collection. Each note has a row, and the created date (as epoch
+seconds), prefix and priority are stored in compact arrays. This allows
+selecting by prefix and sorting by date without touching the note
+objects. If numpy is available, these operations are vectorized. The
+rows are also kept sorted by prefix and created date, so that notes can
+be produced in display order one by one, and a date range can be found
+by bisection.
+"""
+
+import heapq
+import itertools
+from array import array
+from bisect import bisect_left, bisect_right, insort
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .headercodec import toEpoch
+
+
+# The known prefixes, the index is the code. Free rows have code -1.
+PREFIXES = ['%', '%%', '%%%', '!', '!!', '!!!', '?', '??', '???', '.']
+PREFIX_CODES = dict((prefix, code) for code, prefix in enumerate(PREFIXES))
+
+
+class ColumnStore:
+    """ Columnar store for the metadata of notes, indexed by a dense
+    row number.
+    """
+
+    def __init__(self):
+        self._notes = []  # row -> note
+        self._rows = {}  # note id -> row
+        self._freeRows = []
+        self._byCode = None  # prefix code -> sorted (created, -row), made on demand
+        # Columns
+        self.created = array('q')
+        self.prefixes = array('b')
+        self.priorities = array('b')
+
+    def __len__(self):
+        return len(self._rows)
+
+    def set(self, note):
+        """ Add or update the row for the given note.
+        """
+        row = self._rows.get(note.id, None)
+        if row is None:
+            if self._freeRows:
+                row = self._freeRows.pop()
+            else:
+                row = len(self._notes)
+                self._notes.append(None)
+                for column in self._columns():
+                    column.append(0)
+            self._rows[note.id] = row
+        elif self._byCode is not None:
+            self._unsort(row)
+        self._notes[row] = note
+        self.created[row] = toEpoch(note.created)
+        self.prefixes[row] = PREFIX_CODES.get(note.prefix, 0)
+        self.priorities[row] = note.priority
+        if self._byCode is not None:
+            insort(self._byCode[self.prefixes[row]], (self.created[row], -row))
+
+    def remove(self, id):
+        """ Remove the row for the note with the given id.
+        """
+        row = self._rows.pop(id, None)
+        if row is not None:
+            if self._byCode is not None:
+                self._unsort(row)
+            self._notes[row] = None
+            self.prefixes[row] = -1
+            self._freeRows.append(row)
+
+    def select(self, prefix='', ids=None, since=None, until=None, reverse=False):
+        """ Get the notes that have the given prefix, or all notes except
+        the hidden ones if prefix is empty. The notes are sorted by created
+        date (newest first, or oldest first if reverse is True), and by
+        priority first if a prefix is given. If ids is given, only the notes
+        with these ids are considered. If since and/or until are given (as
+        epoch seconds), only notes created in [since, until) are considered.
+        """
+        if since is not None or until is not None:
+            return list(self.iterSelect(prefix, ids, since, until, reverse))
+
+        codes = self._codes(prefix)
+        if ids is not None:
+            rows = [self._rows[id] for id in ids if id in self._rows]
+            rows.sort()  # Notes with equal dates stay in row order
+        else:
+            rows = None
+
+        if np is not None:
+            rows = self._selectNumpy(codes, bool(prefix), rows, reverse)
+        else:
+            codes = set(codes)
+            if rows is None:
+                rows = [row for row, code in enumerate(self.prefixes) if code in codes]
+            else:
+                prefixes = self.prefixes
+                rows = [row for row in rows if prefixes[row] in codes]
+            self._sortRows(rows, bool(prefix), reverse)
+
+        notes = self._notes
+        return [notes[row] for row in rows]
+
+    def iterSelect(self, prefix='', ids=None, since=None, until=None, reverse=False):
+        """ Like select(), but yields the notes one at a time, from the
+        rows that the store keeps in display order. Getting the first notes
+        is therefore cheap, regardless of how many notes match. The store
+        may be changed during iteration: notes that are removed in the
+        mean time are skipped (rows are reused, so ids are checked).
+        """
+        codes = self._codes(prefix)
+        byCode = self._sortedByCode()
+        idSet = None
+        if ids is not None:
+            rows = [self._rows[id] for id in ids if id in self._rows]
+            if len(rows) * 8 < sum(len(byCode[code]) for code in codes):
+                # Few matches among many notes; sorting them is faster
+                rows = [row for row in self._inRange(rows, since, until)
+                        if self.prefixes[row] in codes]
+                self._sortRows(rows, bool(prefix), reverse)
+                notes = self._notes
+                for id in [notes[row].id for row in rows]:
+                    row = self._rows.get(id, None)
+                    if row is not None:
+                        yield notes[row]
+                return
+            idSet = ids if isinstance(ids, (set, frozenset)) else set(ids)
+        runs = [self._iterCode(code, since, until, reverse) for code in codes]
+        if prefix:
+            entries = itertools.chain(*runs)
+        else:
+            entries = heapq.merge(*runs, reverse=not reverse)
+        notes = self._notes
+        for created, negRow in entries:
+            note = notes[-negRow]
+            if idSet is None or note.id in idSet:
+                yield note
+
+    def _codes(self, prefix):
+        # Get the codes for the given prefix, sorted by priority
+        if prefix:
+            codes = [c for p, c in PREFIX_CODES.items() if p.startswith(prefix)]
+        else:
+            codes = [c for p, c in PREFIX_CODES.items() if p != '.']
+        codes.sort(key=lambda code: len(PREFIXES[code]), reverse=True)
+        return codes
+
+    def _sortRows(self, rows, byPriority, reverse):
+        # Sort the rows in display order. Rows are first sorted so that
+        # the order is reversed exactly (including notes with equal dates).
+        rows.sort(reverse=reverse)
+        rows.sort(key=self.created.__getitem__, reverse=not reverse)
+        if byPriority:
+            rows.sort(key=self.priorities.__getitem__, reverse=True)
+
+    def _selectNumpy(self, codes, byPriority, rows=None, reverse=False):
+        # Note that the views on the arrays must not outlive this call,
+        # because an array cannot be resized while it is being viewed.
+        if not self._notes or rows == []:
+            return []
+        prefixes = np.frombuffer(self.prefixes, np.int8)
+        if rows is None:
+            rows = np.flatnonzero(np.isin(prefixes, codes))
+        else:
+            rows = np.array(rows, np.int64)
+            rows = rows[np.isin(prefixes[rows], codes)]
+        if reverse:
+            rows = rows[::-1]
+        created = np.frombuffer(self.created, np.int64)[rows]
+        if not reverse:
+            created = -created
+        if byPriority:
+            priorities = np.frombuffer(self.priorities, np.int8)[rows]
+            order = np.lexsort((created, -priorities))
+        else:
+            order = np.argsort(created, kind='stable')
+        return rows[order].tolist()
+
+    def _inRange(self, rows, since, until):
+        created = self.created
+        return [row for row in rows
+                if (since is None or created[row] >= since) and
+                (until is None or created[row] < until)]
+
+    def _iterCode(self, code, since, until, reverse):
+        # Yield the (created, -row) entries for the given prefix code in
+        # [since, until), newest first unless reverse is True. The position
+        # is found by bisection at each step, so that the list can change.
+        entries = self._byCode[code]
+        if reverse:
+            key = None if since is None else (since, )
+            while True:
+                i = 0 if key is None else bisect_right(entries, key)
+                if i >= len(entries) or (until is not None and entries[i][0] >= until):
+                    return
+                key = entries[i]
+                yield key
+        else:
+            key = None if until is None else (until, )
+            while True:
+                i = len(entries) if key is None else bisect_left(entries, key)
+                if i == 0 or (since is not None and entries[i - 1][0] < since):
+                    return
+                key = entries[i - 1]
+                yield key
+
+    def _sortedByCode(self):
+        if self._byCode is None:
+            byCode = dict((code, []) for code in range(len(PREFIXES)))
+            created, prefixes = self.created, self.prefixes
+            for row in self._rows.values():
+                byCode[prefixes[row]].append((created[row], -row))
+            for entries in byCode.values():
+                entries.sort()
+            self._byCode = byCode
+        return self._byCode
+
+    def _unsort(self, row):
+        # Remove a row from the lists sorted by created date
+        entries = self._byCode[self.prefixes[row]]
+        i = bisect_left(entries, (self.created[row], -row))
+        del entries[i]
+
+    def _columns(self):
+        return (self.created, self.prefixes, self.priorities)
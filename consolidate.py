@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" notes.consolidate
+This module implements consolidating note files into a single file, as
+a streaming merge. The files are read one note at a time: first to find
+the latest version of each note, then to write sorted runs of these
+versions to temporary files, which are merged with heapq.merge. Only
+the id and version of each note, and one run of notes, are kept in
+memory, so that the texts of all notes never need to fit in memory.
+"""
+
+import os
+import heapq
+import pickle
+import tempfile
+import threading
+
+from .noteproxy import _WHITESPACE, getPrefix, isSegment
+from .headercodec import decodeHeader, decodeModified, textId, toEpoch
+
+
+# The number of notes to sort in memory at once
+RUN_SIZE = 10000
+
+
+def iterEntries(filename):
+    """ Iterate over the notes in the given file, reading it line by
+    line. Yields (header, text) tuples, in which header is the decoded
+    header without the '----', and text the stripped bytes of the text.
+    Completely empty notes are skipped (like splitNotes()).
+    """
+    with open(filename, 'rb') as f:
+        yield from readEntries(f)
+
+
+def readEntries(f):
+    """ Like iterEntries(), but for a file object opened in binary mode
+    (e.g. a gzip file).
+    """
+    header, lines = None, []
+    for line in f:
+        if header is None:
+            header = line.decode('utf-8', 'ignore').strip().strip('-')
+        elif line.startswith(b'----'):
+            text = b''.join(lines).strip(_WHITESPACE)
+            if header or text:
+                yield header, text
+            header = line[4:].decode('utf-8', 'ignore').strip().strip('-')
+            lines = []
+        else:
+            lines.append(line)
+    if header is not None:
+        text = b''.join(lines).strip(_WHITESPACE)
+        if header or text:
+            yield header, text
+
+
+def entryInfo(header, text):
+    """ Get a tuple (id, version, deleted, key) for an entry as yielded
+    by iterEntries(), in which version is the modified string, and key
+    sorts notes by date (hidden notes first). Returns None for entries
+    without id and text.
+    """
+    id, created, createdStr, modified, deleted = decodeHeader(header)
+    if id is None:
+        decoded = text.decode('utf-8', 'ignore').strip()
+        if not decoded:
+            return None  # Nothing to keep
+        id = textId(decoded + '\n')
+    version = decodeModified(modified, created)[1]
+    prefix = getPrefix(text[:64].decode('utf-8', 'ignore').lstrip() or
+                       text.decode('utf-8', 'ignore'))
+    return id, version, deleted, (prefix != '.', toEpoch(created))
+
+
+def _writeRun(run, tempdir):
+    # Sort a run and write it to a temporary file; return its name
+    run.sort()
+    fd, filename = tempfile.mkstemp('.run', 'notes', tempdir)
+    with os.fdopen(fd, 'wb') as f:
+        for item in run:
+            pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+    return filename
+
+
+def _readRun(filename):
+    with open(filename, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def consolidate(filenames, filename, progress=None, tempdir=None):
+    """ Write the latest version of each note in the given files to the
+    file with the given name (which may be one of them), sorted by date,
+    with hidden notes first. Deleted notes are left out. The file is
+    written to a temporary file first, and then replaces the original.
+    The sorted runs are written to tempdir (by default the temp dir of
+    the system), so not to the (maybe synced) folder of the notes.
+    If given, progress is called with the fraction of the work done.
+    Returns the number of notes written.
+    """
+    total = 2 * sum(os.path.getsize(fname) for fname in filenames) or 1
+    done = 0
+
+    # Find the latest version of each note
+    latest = {}  # id -> ((version, deleted, not sealed), file index, entry index)
+    for fileIndex, fname in enumerate(filenames):
+        unsealed = not isSegment(fname)
+        for entryIndex, (header, text) in enumerate(iterEntries(fname)):
+            done += len(header) + len(text)
+            info = entryInfo(header, text)
+            if info is None:
+                continue
+            id, version, deleted, key = info
+            # Like in a collection: a later version wins, and with the same
+            # time a deletion wins, then a version in a file that is not a
+            # sealed segment. Within a file, the last one wins, otherwise
+            # the first.
+            rank = version, deleted, unsealed
+            cur = latest.get(id, None)
+            if (cur is None or rank > cur[0] or
+                    (rank == cur[0] and cur[1] == fileIndex)):
+                latest[id] = rank, fileIndex, entryIndex
+        if progress:
+            progress(done / total)
+
+    # Write these as sorted runs. Entries are numbered to keep the order
+    # of notes with the same key, and so that only keys are compared.
+    tempdir = tempdir or tempfile.gettempdir()
+    runs = []
+    try:
+        run, count = [], 0
+        for fileIndex, fname in enumerate(filenames):
+            for entryIndex, (header, text) in enumerate(iterEntries(fname)):
+                done += len(header) + len(text)
+                info = entryInfo(header, text)
+                if info is None:
+                    continue
+                id, version, deleted, key = info
+                rank, latestFile, latestEntry = latest[id]
+                if (latestFile, latestEntry) != (fileIndex, entryIndex) or rank[1]:
+                    continue  # Superseded or deleted
+                run.append(key + (count, header, text))
+                count += 1
+                if len(run) >= RUN_SIZE:
+                    runs.append(_writeRun(run, tempdir))
+                    run = []
+            if progress:
+                progress(done / total)
+        if run:
+            runs.append(_writeRun(run, tempdir))
+        del run, latest
+
+        # Merge the runs into a new file next to it, and swap it in
+        tempname = filename + '.tmp'
+        with open(tempname, 'wb') as f:
+            for item in heapq.merge(*[_readRun(r) for r in runs]):
+                header, text = item[-2:]
+                f.write(('\n---- %s\n' % header).encode('utf-8'))
+                f.write(text + b'\n')
+        os.replace(tempname, filename)
+    finally:
+        for r in runs:
+            os.remove(r)
+    if progress:
+        progress(1.0)
+    return count
+
+
+def clearFiles(filenames):
+    """ Clear the given note files, e.g. after consolidating them. Sealed
+    segments are removed, other files are truncated.
+    """
+    for filename in filenames:
+        if isSegment(filename):
+            os.remove(filename)
+        else:
+            open(filename, 'wb').close()
+
+
+class Consolidator:
+    """ Consolidate note files in a worker thread. After the files have
+    been merged into the given filename, the files in clear are cleared.
+    The progress (a fraction) can be read while it runs. The sorted runs
+    are written to tempdir (see consolidate()).
+    """
+
+    def __init__(self, filenames, filename, clear=(), tempdir=None):
+        self._filenames = list(filenames)
+        self._filename = filename
+        self._clear = [f for f in clear if f != filename]
+        self._tempdir = tempdir
+        self._thread = None
+        self.progress = 0.0
+        self.count = 0  # The number of notes written
+        self.error = None
+        self.done = False
+
+    def start(self):
+        """ Start consolidating.
+        """
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='Consolidator')
+        self._thread.start()
+
+    def wait(self):
+        """ Wait until consolidating is done.
+        """
+        if self._thread is not None:
+            self._thread.join()
+
+    def _setProgress(self, progress):
+        self.progress = progress
+
+    def _run(self):
+        try:
+            self.count = consolidate(self._filenames, self._filename,
+                                     self._setProgress, self._tempdir)
+            clearFiles(self._clear)
+        except Exception as err:
+            self.error = err
+        finally:
+            self.done = True
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" notes.headercodec
+This module implements the parsing and generation of the separator lines
+(headers) of notes. Dates are recognized with precompiled patterns
+instead of trying each format with strptime, and the date and time parts
+are memoized, because many notes share the same day.
+"""
+
+import re
+import hashlib
+import datetime
+
+
+# Dateless notes get a date in the future (only for sorting)
+NEVER = datetime.datetime(9000, 1, 1)
+
+# Dates are naive, so epoch timestamps are relative to a naive epoch
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Patterns for the supported formats: YYYY-MM-DD, YYYYMMDD, HH:MM, HH:MM:SS
+_DATE_RE = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})$')
+_COMPACTDATE_RE = re.compile(r'(\d{4})(\d{2})(\d{2})$')
+_TIME_RE = re.compile(r'(\d{1,2}):(\d{1,2})(?::(\d{1,2}))?$')
+_PERIOD_RE = re.compile(r'(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?$')
+
+# Memoization of date and time parts, and of full date strings
+_MAXCACHE = 100000
+_dateCache = {}
+_timeCache = {}
+_dateTimeCache = {}
+_MISSING = object()
+
+
+def _parseDatePart(s):
+    m = _DATE_RE.match(s) or _COMPACTDATE_RE.match(s)
+    ymd = None
+    if m:
+        ymd = int(m.group(1)), int(m.group(2)), int(m.group(3))
+        try:
+            datetime.date(*ymd)
+        except ValueError:
+            ymd = None
+    if len(_dateCache) > _MAXCACHE:
+        _dateCache.clear()
+    _dateCache[s] = ymd
+    return ymd
+
+
+def _parseTimePart(s):
+    m = _TIME_RE.match(s)
+    hms = None
+    if m:
+        hms = int(m.group(1)), int(m.group(2)), int(m.group(3) or 0)
+        if not (hms[0] < 24 and hms[1] < 60 and hms[2] < 60):
+            hms = None
+    if len(_timeCache) > _MAXCACHE:
+        _timeCache.clear()
+    _timeCache[s] = hms
+    return hms
+
+
+def parseDate(s):
+    """ Parse a date string in one of the supported formats. Returns
+    a datetime object, or None if the string is not a valid date.
+    """
+    dt = _dateTimeCache.get(s, _MISSING)
+    if dt is not _MISSING:
+        return dt
+    datePart, space, timePart = s.strip().partition(' ')
+    dt = None
+    ymd = _dateCache.get(datePart, _MISSING)
+    if ymd is _MISSING:
+        ymd = _parseDatePart(datePart)
+    if ymd is not None:
+        timePart = timePart.strip()
+        if not timePart:
+            dt = datetime.datetime(*ymd)
+        elif '-' in datePart:
+            # Time is not supported for the compact format
+            hms = _timeCache.get(timePart, _MISSING)
+            if hms is _MISSING:
+                hms = _parseTimePart(timePart)
+            if hms is not None:
+                dt = datetime.datetime(ymd[0], ymd[1], ymd[2], *hms)
+    if len(_dateTimeCache) > _MAXCACHE:
+        _dateTimeCache.clear()
+    _dateTimeCache[s] = dt
+    return dt
+
+
+def parsePeriod(s):
+    """ Parse a year (YYYY), month (YYYY-MM) or day (YYYY-MM-DD). Returns
+    a tuple (start, end) of datetime objects, in which end is the start of
+    the next period, or None if the string is not a valid period.
+    """
+    m = _PERIOD_RE.match(s.strip())
+    if not m:
+        return None
+    year, month, day = m.groups()
+    try:
+        if day:
+            start = datetime.datetime(int(year), int(month), int(day))
+            return start, start + datetime.timedelta(1)
+        elif month:
+            start = datetime.datetime(int(year), int(month), 1)
+            if start.month == 12:
+                return start, start.replace(year=start.year + 1, month=1)
+            return start, start.replace(month=start.month + 1)
+        else:
+            start = datetime.datetime(int(year), 1, 1)
+            return start, start.replace(year=start.year + 1)
+    except ValueError:
+        return None
+
+
+def formatCreated(dt):
+    """ Get the string representation of a created date.
+    """
+    return '%04i-%02i-%02i' % (dt.year, dt.month, dt.day)
+
+
+def formatModified(dt):
+    """ Get the string representation of a modified date.
+    """
+    return '%04i-%02i-%02i %02i:%02i:%02i' % (
+                dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
+
+
+def toEpoch(dt):
+    """ Convert a datetime object to integer seconds since the epoch.
+    """
+    delta = dt - EPOCH
+    return delta.days * 86400 + delta.seconds
+
+
+def fromEpoch(t):
+    """ Convert integer seconds since the epoch to a datetime object.
+    """
+    return EPOCH + datetime.timedelta(0, t)
+
+
+def splitHeader(header):
+    """ Split a header (without the '----') in its raw (id, created,
+    modified) strings, and a bool deleted. The id is None if the header
+    does not specify one.
+    """
+    created = ''
+    modified = ''
+    id = None
+    deleted = False
+    for part in header.strip(' \t\n\r-:').split(','):
+        key, colon, value = part.partition(':')
+        key, value = key.strip(), value.strip()
+        #
+        if key == 'id':
+            id = value
+        elif key in ('c', 'created'):
+            created = value
+        elif key in ('m', 'modified'):
+            modified = value
+        elif key == 'deleted':
+            deleted = value not in ('', 'no', '0')
+        elif part:
+            created = part.strip()
+    return id, created, modified, deleted
+
+
+def decodeCreated(created):
+    """ Decode the raw created string. Returns a tuple (created, createdStr).
+    If the string is not a valid date, created is NEVER and createdStr
+    is empty.
+    """
+    dt = parseDate(created) if created else None
+    if dt is None:
+        return NEVER, ''
+    else:
+        return dt, formatCreated(dt)
+
+
+def decodeHeader(header):
+    """ Decode a single header. Returns a tuple (id, created, createdStr,
+    modified, deleted), in which created is a datetime object (NEVER for
+    dateless notes), and modified is the raw string, which can be parsed
+    on demand with decodeModified(). The id is None if not specified in
+    the header. Deleted is True for tombstones.
+    """
+    id, created, modified, deleted = splitHeader(header)
+    return (id, ) + decodeCreated(created) + (modified, deleted)
+
+
+def decodeHeaders(headers):
+    """ Decode all headers of a file in one pass. Returns a list of tuples
+    as returned by decodeHeader().
+    """
+    # Headers written by the app mostly differ only in their id, so
+    # most dates are found in the cache and formatted only once per day.
+    result = []
+    append = result.append
+    cache = _dateTimeCache
+    createdStrs = {}
+    for header in headers:
+        id, created, modified, deleted = splitHeader(header)
+        dt = cache.get(created) if created else None
+        if dt is None and created:
+            dt = parseDate(created)
+        if dt is None:
+            append((id, NEVER, '', modified, deleted))
+        else:
+            createdStr = createdStrs.get(dt)
+            if createdStr is None:
+                createdStr = createdStrs[dt] = formatCreated(dt)
+            append((id, dt, createdStr, modified, deleted))
+    return result
+
+
+def decodeModified(modified, created):
+    """ Decode the raw modified string. Returns a tuple (modified,
+    modifiedStr). If the string is not a valid date, the created date
+    is used, and modifiedStr is empty.
+    """
+    dt = parseDate(modified) if modified else None
+    if dt is None:
+        return created, ''
+    else:
+        return dt, formatModified(dt)
+
+
+def encodeHeader(id, createdStr, modifiedStr, deleted=False):
+    """ Generate a header from its components. The deleted field comes
+    before the dates, because older versions of the app take an unknown
+    field for the created date, unless a c field follows.
+    """
+    if deleted:
+        return 'id:%s, deleted:yes, c:%s, m:%s' % (id, createdStr, modifiedStr)
+    return 'id:%s, c:%s, m:%s' % (id, createdStr, modifiedStr)
+
+
+def textId(text):
+    """ Get the id for a note that does not specify one in its header.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
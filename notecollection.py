@@ -9,26 +9,127 @@ a collection.
 
 import os
 import sys
+import sqlite3
+import multiprocessing
+import concurrent.futures
 
-from .noteproxy import FileProxy, Note
+from .noteproxy import (FileProxy, Note, parseFile, isNoteFile, isSegment,
+                        segmentName, segmentNumber)
+from .columnstore import ColumnStore
+from .noteindex import InvertedIndex
+from .headercodec import NEVER, toEpoch
+from .notequery import QueryCache, compileQuery
+from .consolidate import Consolidator, consolidate
+from .sqlindex import SqlIndex, indexFilename
+from . import snapshot
+
+
+# Files are parsed in a process pool only if there is enough to parse
+PARALLEL_MIN_FILES = 4
+PARALLEL_MIN_BYTES = 4 * 2**20
+
+# The number of notes to return for a ranked query
+RANKED_LIMIT = 100
+
+
+class Vocabulary:
+    """ Shared vocabulary of the tags and words in a collection. Each
+    token is stored only once, and has an integer id.
+    """
+    
+    def __init__(self):
+        self._ids = {}  # token -> id
+        self._tokens = []  # id -> token
+    
+    def __len__(self):
+        return len(self._tokens)
+    
+    def intern(self, token):
+        """ Get the shared instance of the given token.
+        """
+        try:
+            return self._tokens[self._ids[token]]
+        except KeyError:
+            self._ids[token] = len(self._tokens)
+            self._tokens.append(token)
+            return token
+    
+    def tokenId(self, token):
+        """ Get the integer id for the given token.
+        """
+        self.intern(token)
+        return self._ids[token]
+    
+    def token(self, id):
+        """ Get the token corresponding to the given integer id.
+        """
+        return self._tokens[id]
+
+
+
+class ChangeSet:
+    """ The changes that an update made to a collection: the ids of the
+    notes that were added, modified and removed, and the names of the
+    files that were loaded. Is False if no notes changed.
+    """
+    
+    def __init__(self):
+        self.added = set()
+        self.modified = set()
+        self.removed = set()
+        self.files = []
+    
+    def __repr__(self):
+        return '<ChangeSet with %i added, %i modified, %i removed>' % (
+                len(self.added), len(self.modified), len(self.removed))
+    
+    def __bool__(self):
+        return bool(self.added or self.modified or self.removed)
+    
+    @property
+    def ids(self):
+        """ The ids of all notes that changed.
+        """
+        return self.added | self.modified | self.removed
 
 
 class NoteCollection:
     """ Represent a collection of notes. Handles the combining of multiple
-    file proxies. 
+    file proxies. If cacheDir is given, the parsed notes are cached
+    in that directory, to speed up loading the collection. In appendOnly
+    mode, saved and deleted notes are appended to the file of this device,
+    instead of rewriting the whole file. In background mode, files are
+    written in a worker thread, and multiple saves are combined. The
+    tags and words are indexed in memory, or with index='sqlite' in an
+    SQLite database (in cacheDir if given), for very large collections.
     """ 
-    def __init__(self, *filenames):
+    def __init__(self, *filenames, cacheDir=None, appendOnly=False,
+                 background=False, index='memory'):
         
         # List of file proxies and set of notes contained therein
         self._fileProxies = []
         self._notes = {}
+        self._tombstones = {}  # Deleted notes
+        self._edited = {}  # id -> note that is being edited, to index later
+        self._owners = {}  # note id -> file proxies that have (had) a version of it
+        self._store = ColumnStore()  # Columnar metadata of the notes in _notes
+        self._index = self._createIndex(index, cacheDir, filenames)
+        self._closed = False
+        self.vocabulary = Vocabulary()
+        self.generation = 0  # Incremented each time that a note changes
+        self.queryCache = QueryCache()
+        self.folder = None  # Set by fromFolder(), to discover new files
+        self._cacheDir = cacheDir
+        self._appendOnly = appendOnly
+        self._background = background
         mainProxy = None
         
         # Create proxies
         for filename in filenames:
             if not os.path.isfile(filename):
                 raise ValueError('Note file does not exist: %r' % filename)
-            newProxy = FileProxy(filename, mainProxy)
+            newProxy = FileProxy(filename, mainProxy, cacheDir, self, appendOnly,
+                                 background, mainProxy is not None and isSegment(filename))
             self._fileProxies.append(newProxy)
             mainProxy = mainProxy or newProxy
         #if not self._fileProxies:
@@ -37,9 +138,27 @@ class NoteCollection:
         # Query notes
         self.update()
     
+    def _createIndex(self, index, cacheDir, filenames):
+        """ Create the index for the tags and words of the notes.
+        """
+        if index == 'memory':
+            return InvertedIndex()
+        elif index != 'sqlite':
+            raise ValueError('Invalid index %r' % index)
+        filename = ':memory:'
+        if cacheDir and filenames:
+            filename = indexFilename(cacheDir, filenames[0])
+        try:
+            return SqlIndex(filename)
+        except sqlite3.Error as err:
+            print('Using the in-memory index, because the SQLite index '
+                  'is not available: %s' % err)
+            return InvertedIndex()
+    
     
     @classmethod
-    def fromFolder(cls, folder, computername):
+    def fromFolder(cls, folder, computername, cacheDir=None, appendOnly=False,
+                   background=False, index='memory'):
         if not os.path.isdir(folder):
             raise ValueError('The given note folder does not exist: %r' % folder)
         
@@ -55,12 +174,39 @@ class NoteCollection:
             filename = os.path.normcase(os.path.join(folder,fname))
             if filename == mainfile:
                 continue
-            elif filename.count('.') >= 2 and filename.endswith('.txt'):
+            elif isNoteFile(filename):
                 files.append(filename)
         
         # Create collection
-        return NoteCollection(*files)
+        collection = NoteCollection(*files, cacheDir=cacheDir, appendOnly=appendOnly,
+                                    background=background, index=index)
+        collection.folder = folder
+        return collection
+    
     
+    @classmethod
+    def loadSnapshot(cls, filename, cacheDir=None, appendOnly=False,
+                     background=False, index='memory'):
+        """ Create a collection from a snapshot (see saveSnapshot()),
+        without parsing the notes. Files that have changed since the
+        snapshot was made are loaded as usual.
+        """
+        collection = NoteCollection(cacheDir=cacheDir, appendOnly=appendOnly,
+                                    background=background, index=index)
+        snapshot.loadSnapshot(collection, filename)
+        # Now that the files are known, use the same index as fromFolder()
+        filenames = [p._filename for p in collection._fileProxies]
+        collection._index.close()
+        collection._index = collection._createIndex(index, cacheDir, filenames)
+        collection.update()
+        return collection
+    
+    def saveSnapshot(self, filename):
+        """ Write a binary snapshot of the collection to the given file,
+        from which it can be loaded quickly with loadSnapshot(). The text
+        files remain the source of truth.
+        """
+        snapshot.saveSnapshot(self, filename)
     
     def __len__(self):
         return len(self._notes)
@@ -68,46 +214,352 @@ class NoteCollection:
     def __iter__(self):
         return self._notes.values().__iter__()
     
+    @property
+    def keepsTokens(self):
+        """ Whether the index keeps the tags and words of all notes in
+        memory. If not, notes should not be filtered by their tags and
+        words, because that parses them (and keeps their tokens).
+        """
+        return self._index.keepsTokens
+    
     def newNote(self):
         """ Create a new note in the default file.
         """
         note = self._fileProxies[0].newNote()
-        self._notes[note.id] = note
+        self._addOwner(note._fileProxy, note.id)
+        self._setNote(note)
         return note
     
-    def update(self):
-        updated = []
-        for fileProxy in self._fileProxies:
-            if fileProxy.hasChanged():
-                updated.append(fileProxy._filename)
-                #curNotes = fileProxy.currentNotes()
-                newNotes = fileProxy.getNotes()
-                for note in newNotes:
-                    curNote = self._notes.get(note.id, None)
-                    if curNote is None:
-                        self._notes[note.id] = note
-                    elif note.modifiedStr >= curNote.modifiedStr:
-                        self._notes[note.id] = note
-        return updated
-    
-    def save_consolidated(self, filename):
-        notes = list(self._notes.values())
-        notes.sort(key=lambda n: (n.prefix != '.', n.created))
+    def select(self, prefix=''):
+        """ Get the notes that have the given prefix (or all notes that
+        are not hidden), in the order to display them: sorted by date,
+        and if a prefix is given, by priority first.
+        """
+        return self._store.select(prefix)
+    
+    def query(self, prefix='', tags=(), words=(), ranked=False,
+              limit=RANKED_LIMIT, since=None, until=None, reverse=False):
+        """ Get the notes that have the given prefix (see select()), and
+        all the given tags and words, in the order to display them. A word
+        also matches the corresponding tag, and the tag '#' matches notes
+        without tags. If ranked is True and words are given, the best
+        matching notes (at most limit) are returned, sorted by relevance.
+        If since and/or until (datetime objects) are given, only notes
+        created in that range are selected (dateless notes are excluded).
+        If reverse is True, the oldest notes come first.
+        """
+        args = self._queryArgs(tags, words, since, until)
+        notes = self._store.select(prefix, *args, reverse=reverse)
+        if ranked and words:
+            notes = self._index.rank(notes, words, limit)
+        return notes
+    
+    def iterQuery(self, prefix='', tags=(), words=(), ranked=False,
+                  limit=RANKED_LIMIT, since=None, until=None, reverse=False):
+        """ Like query(), but get an iterator that produces the notes
+        one at a time, so that getting the first notes is cheap. (Except
+        in ranked mode, because all matches must be scored.)
+        """
+        if ranked and words:
+            return iter(self.query(prefix, tags, words, ranked, limit,
+                                   since, until, reverse))
+        args = self._queryArgs(tags, words, since, until)
+        return self._store.iterSelect(prefix, *args, reverse=reverse)
+    
+    def _queryArgs(self, tags, words, since, until):
+        # Get the ids and date range arguments for the column store
+        if since is not None or until is not None:
+            since = None if since is None else toEpoch(since)
+            until = toEpoch(min(until or NEVER, NEVER))
+        ids = None
+        if tags or words:
+            self._buildIndex()
+            ids = self._index.lookup(tags, words)
+        return ids, since, until
+    
+    def find(self, text, ranked=False):
+        """ Get the notes selected by the given query text (see the
+        notequery module), as a LazyResult. Results are cached until the
+        collection changes.
+        """
+        return self.queryCache.run(compileQuery(text), self, ranked)
+    
+    def allTags(self, prefix=None):
+        """ Get the set of all tags in the collection, or if a prefix is
+        given, of the notes that select() gives for that prefix.
+        """
+        self._buildIndex()
+        if prefix is None:
+            return self._index.tags()
+        return self._index.tags(note.id for note in self.select(prefix))
+    
+    def _buildIndex(self):
+        if not self._index.built:
+            self._edited.clear()
+            self._index.build(self._notes.values())
+        self._indexEdited()
+    
+    def _indexEdited(self):
+        # Index the notes that have been edited, and commit the index
+        for note in self._edited.values():
+            if self._notes.get(note.id, None) is note:
+                self._index.add(note)
+        self._edited.clear()
+        self._index.commit()
+    
+    def _setNote(self, note):
+        self.generation += 1
+        if note.deleted:
+            self._removeNote(note.id)
+            self._tombstones[note.id] = note
+        else:
+            self._tombstones.pop(note.id, None)
+            self._notes[note.id] = note
+            self._store.set(note)
+            self._index.add(note)
+    
+    def _removeNote(self, id):
+        self.generation += 1
+        self._notes.pop(id, None)
+        self._store.remove(id)
+        self._index.remove(id)
+    
+    def _noteChanged(self, note):
+        """ Called by a note when it has changed (or is a new tombstone).
+        A note that is being edited (e.g. on each key press) is indexed
+        when it is saved, or when the index is used.
+        """
+        self._addOwner(note._fileProxy, note.id)
+        if self._notes.get(note.id, None) is not note and not note.deleted:
+            return
+        if note.deleted or note._text == note._text0:
+            self._edited.pop(note.id, None)
+            self._setNote(note)
+            self._index.commit()
+        else:
+            self.generation += 1
+            self._store.set(note)
+            self._edited[note.id] = note
+    
+    def update(self, filenames=None):
+        """ Load the notes from files that have been changed from the
+        outside. If filenames is given, only these files are checked.
+        Only the notes that are (or were) in these files are reconsidered,
+        so notes that were removed, or deleted on another device, are
+        removed from the collection too. Returns a ChangeSet.
+        """
+        changes = ChangeSet()
+        self._addFiles(filenames)
+        fileProxies = self._fileProxies
+        if filenames is not None:
+            filenames = set(filenames)
+            fileProxies = [p for p in fileProxies if p._filename in filenames]
+        changed = [p for p in fileProxies if p.hasChanged()]
+        parsed = self._parseFiles([p for p in changed if p.needsFullParse()])
+        
+        # Load the files, and collect the ids for which they changed
+        touched = set()
+        for fileProxy in changed:
+            changes.files.append(fileProxy._filename)
+            oldLatest = fileProxy._latest
+            fileProxy.getNotes(parsed.get(fileProxy._filename))
+            newLatest = fileProxy._latest
+            for id, note in newLatest.items():
+                if oldLatest.get(id, None) is not note:
+                    touched.add(id)
+                    self._addOwner(fileProxy, id)
+            touched.update(id for id in oldLatest if id not in newLatest)
         
-        with open(filename, 'wb') as f:
-            for note in notes:
-                fullheader = '\n---- %s\n' % note._header 
-                f.write(fullheader.encode('utf-8'))
-                f.write(note.text.encode('utf-8'))
-    
-    # def check_deleted(self):
-    #     all_note_ids = []
-    #     for fileProxy in self._fileProxies:
-    #         all_note_ids.extend([n.id for n in fileProxy._notes])
-    #     all_note_ids = set(all_note_ids)
-    #     
-    #     for id in list(self._notes.keys()):
-    #         if id not in all_note_ids
-            
-            
-            
+        self._selectVersions(touched, changes, set(changed))
+        self._indexEdited()
+        return changes
+    
+    def _addOwner(self, fileProxy, id):
+        owners = self._owners.setdefault(id, [])
+        if fileProxy not in owners:
+            owners.append(fileProxy)
+    
+    def _selectVersions(self, ids, changes=None, loaded=()):
+        """ Select the latest version of the notes with the given ids
+        over all files, and record the changes in the given ChangeSet.
+        If versions have the same time, a deletion wins, then a version
+        from the given (just loaded) file proxies, then a version from
+        a file that is not sealed, and then the current version.
+        """
+        if changes is None:
+            changes = ChangeSet()
+        for id in ids:
+            curNote = self._notes.get(id, None)
+            if curNote is None:
+                curNote = self._tombstones.get(id, None)
+            owners = [p for p in self._owners.get(id, ()) if id in p._latest]
+            if owners:
+                self._owners[id] = owners
+            else:
+                self._owners.pop(id, None)
+            winner, winnerKey = None, None  # None if no longer in any file
+            if len(owners) == 1:
+                winner = owners[0]._latest[id]  # No need to compare dates
+            else:
+                for fileProxy in owners:
+                    note = fileProxy._latest[id]
+                    key = (note.modifiedStr, note.deleted, fileProxy in loaded,
+                           not fileProxy.sealed, note is curNote)
+                    if winner is None or key > winnerKey:
+                        winner, winnerKey = note, key
+            if winner is curNote:
+                continue
+            present = id in self._notes
+            if winner is None:
+                self._removeNote(id)
+                self._tombstones.pop(id, None)
+            else:
+                self._setNote(winner)
+            if id in self._notes:
+                (changes.modified if present else changes.added).add(id)
+            elif present:
+                changes.removed.add(id)
+    
+    def _addFiles(self, filenames=None):
+        """ Add proxies for new note files in the folder of this
+        collection (if it has one). If filenames is None, the folder is
+        listed to find these.
+        """
+        if not (self.folder and self._fileProxies):
+            return
+        if filenames is None:
+            filenames = [os.path.normcase(os.path.join(self.folder, fname))
+                         for fname in os.listdir(self.folder)]
+        known = set(p._filename for p in self._fileProxies)
+        for filename in filenames:
+            if (filename not in known and isNoteFile(filename) and
+                    os.path.dirname(filename) == os.path.normcase(self.folder) and
+                    os.path.isfile(filename)):
+                newProxy = FileProxy(filename, self._fileProxies[0], self._cacheDir,
+                                     self, self._appendOnly, self._background,
+                                     isSegment(filename))
+                self._fileProxies.append(newProxy)
+    
+    def _parseFiles(self, fileProxies):
+        """ Parse the files of the given proxies in a process pool, if
+        there are enough files to make that worthwhile. Returns a dict
+        that maps filenames to parse results.
+        """
+        filenames = [p._filename for p in fileProxies]
+        nbytes = 0
+        for filename in filenames:
+            try:
+                nbytes += os.path.getsize(filename)
+            except OSError:
+                pass  # Removed; getNotes() handles that
+        if len(filenames) < PARALLEL_MIN_FILES or nbytes < PARALLEL_MIN_BYTES:
+            return {}
+        try:
+            workers = min(len(filenames), os.cpu_count() or 1)
+            # Do not fork this process, because it has threads (writers, the
+            # watcher) and maybe a Qt application; start clean processes.
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods
+                                                  else 'spawn')
+            with concurrent.futures.ProcessPoolExecutor(workers, context) as executor:
+                return dict(zip(filenames, executor.map(parseFile, filenames)))
+        except Exception as err:
+            # E.g. no multiprocessing on this platform; parse in this process
+            print('Could not parse notes in parallel: %s' % err)
+            return {}
+    
+    def compact(self, minGarbage=0.0):
+        """ Rewrite the file of this device without superseded versions of
+        notes, if the fraction of such versions is larger than minGarbage.
+        Returns whether the file was compacted.
+        """
+        if not self._fileProxies:
+            return False
+        fileProxy = self._fileProxies[0]
+        garbage = fileProxy.garbage()
+        if garbage > 0 and garbage > minGarbage * fileProxy._nentries:
+            fileProxy.compact()
+            return True
+        return False
+    
+    def rollover(self, segmentSize):
+        """ Seal the file of this device as a new segment and continue
+        with an empty file, if the file is larger than segmentSize bytes.
+        Sealed segments are not written (nor rewritten on delete), and
+        are not parsed again unless they change, so that the cost of saving
+        and reloading does not grow with the number of notes. Returns
+        whether a new segment was started.
+        """
+        if not (segmentSize and self._fileProxies):
+            return False
+        fileProxy = self._fileProxies[0]
+        # This is called often, so only wait for pending writes when needed
+        try:
+            if os.path.getsize(fileProxy._filename) < segmentSize:
+                return False
+        except OSError:
+            return False
+        fileProxy.flush()
+        if fileProxy.hasChanged():
+            return False
+        # Get the number for the new segment
+        number = 1
+        for p in self._fileProxies:
+            if p.sealed and p._filename.startswith(fileProxy._filename[:-4] + '.'):
+                number = max(number, segmentNumber(p._filename) + 1)
+        while os.path.exists(segmentName(fileProxy._filename, number)):
+            number += 1
+        # Seal it, and let the notes refer to the new proxy
+        sealed = fileProxy.seal(segmentName(fileProxy._filename, number))
+        self._fileProxies.append(sealed)
+        for id in sealed._latest:
+            self._addOwner(sealed, id)
+        sealed.saveCache()
+        return True
+    
+    def saveCache(self):
+        """ Store the parsed notes in the cache, including the tags and
+        words that have been parsed in this session.
+        """
+        for fileProxy in self._fileProxies:
+            fileProxy.saveCache()
+    
+    def flush(self):
+        """ Wait until all saved notes have been written to file.
+        """
+        for fileProxy in self._fileProxies:
+            fileProxy.flush()
+        self._indexEdited()
+    
+    def close(self):
+        """ Write all saved notes and stop writing in the background.
+        Also closes the index; closing twice is allowed.
+        """
+        for fileProxy in self._fileProxies:
+            fileProxy.close()
+        if not self._closed:
+            self._closed = True
+            self._indexEdited()
+            self._index.close()
+    
+    def save_consolidated(self, filename, progress=None):
+        """ Write the latest version of all notes to the given file, sorted
+        by date (hidden notes first). The files are merged as a stream (see
+        the consolidate module), so this does not need much memory. The
+        temporary files are written to the cache dir, if there is one.
+        """
+        self.flush()
+        filenames = [p._filename for p in self._fileProxies]
+        return consolidate(filenames, filename, progress, self._cacheDir)
+    
+    def consolidator(self, filename=None):
+        """ Get a Consolidator to merge all notes into the given file
+        in a worker thread. If no filename is given, the notes are merged
+        into the file of this device, and the other files are cleared
+        afterwards. Call close() on the collection first.
+        """
+        filenames = [p._filename for p in self._fileProxies]
+        if filename is None:
+            return Consolidator(filenames, filenames[0], clear=filenames,
+                                tempdir=self._cacheDir)
+        return Consolidator(filenames, filename, tempdir=self._cacheDir)
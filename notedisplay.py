@@ -13,6 +13,8 @@ import datetime
 
 from qtpy import QtCore, QtGui, QtWidgets
 
+from .notequery import parseSelection
+
 
 # CLR_NOTE = '#268bd2'
 # CLR_TASK = '#cb4b16'  # orange '#cb4b16'   red '#dc322f'
@@ -33,9 +35,13 @@ class NotesContainer(QtWidgets.QWidget):
         
         # List of (heavy) widgets to display a note
         self._noteDisplays = []
-        # List of (light) note objects
+        # Lazy list of (light) note objects, and how many are shown
         self._notesToShow = []
-        self._notesToShow_pending = []  # Notes are not shown yet
+        self._notesShown = 0
+        
+        # Tags for completion, collected on first use
+        self._allTags = set()
+        self._allTagsKey = None
         
         # New note widget
         self._newnote = NewNoteDisplay(self)
@@ -79,7 +85,7 @@ class NotesContainer(QtWidgets.QWidget):
     
     def hasNotesExpanded(self):
         for noteDisplay in self._noteDisplays:
-            if noteDisplay._editor and noteDisplay._editor.isVisible():
+            if noteDisplay.isExpanded():
                 return True
         else:
             return False
@@ -95,122 +101,148 @@ class NotesContainer(QtWidgets.QWidget):
             noteDisplay.close()
         self._noteDisplays = []
         
-        # Select notes and sort
+        # Select notes (these are produced lazily, already sorted)
         self._notesToShow = self._selectNotes()
-        self._notesToShow_pending = list(self._notesToShow) # Copy
+        self._notesShown = 0
         self._showNotes()
     
     
+    def applyChanges(self, changes):
+        """ Update the shown notes for the given ChangeSet (see
+        NoteCollection.update()). Only the widgets of notes that changed
+        are created, updated, moved or removed; notes that are being
+        edited are left alone. Returns the ids of the notes being edited
+        that changed.
+        """
+        if not changes:
+            return set()
+        layout = self.layout()
+        changedIds = changes.ids
+        conflicts = set()
+        
+        # Select notes again (the index is up to date), as many as are shown
+        self._notesToShow = self._selectNotes()
+        notes = self._notesToShow.page(0, max(self._notesShown, 16))
+        self._notesShown = len(notes)
+        
+        # Match the notes with the existing widgets
+        displays = {}
+        for noteDisplay in self._noteDisplays:
+            if noteDisplay.isHidden():
+                layout.removeWidget(noteDisplay)  # Closed by the user
+            else:
+                displays[noteDisplay._note.id] = noteDisplay
+        newDisplays = []
+        for note in notes:
+            noteDisplay = displays.pop(note.id, None)
+            if noteDisplay is None:
+                noteDisplay = NoteDisplay(self, note)
+            elif noteDisplay._note is not note and note.id in changedIds:
+                if noteDisplay.isExpanded():
+                    conflicts.add(note.id)
+                else:
+                    noteDisplay.updateNote(note)
+            newDisplays.append(noteDisplay)
+        
+        # Remove widgets of notes that are no longer selected, except if
+        # they are being edited; these keep their position.
+        for i, noteDisplay in enumerate(self._noteDisplays):
+            if displays.get(noteDisplay._note.id, None) is not noteDisplay:
+                continue
+            elif noteDisplay.isExpanded():
+                if noteDisplay._note.id in changedIds:
+                    conflicts.add(noteDisplay._note.id)
+                newDisplays.insert(min(i, len(newDisplays)), noteDisplay)
+            else:
+                layout.removeWidget(noteDisplay)
+                noteDisplay.close()
+        
+        # Put the widgets in order, moving only those that are out of place
+        previous = self._newnote
+        for noteDisplay in newDisplays:
+            index = layout.indexOf(previous) + 1
+            if layout.indexOf(noteDisplay) != index:
+                layout.removeWidget(noteDisplay)
+                layout.insertWidget(index, noteDisplay, 0)
+            previous = noteDisplay
+        self._noteDisplays = newDisplays
+        
+        self._updateStopper()
+        return conflicts
+    
+    
     def currentSelection(self):
         """ Get more useful representation of what the user is looking for
         (prefix, tags, words).
         """
-        # Get search items
-        items = [i.strip().lower() for i in self._main._select.text().split(' ')]
-        items = [i for i in items if i]
-        
-        prefix = ''
-        tags = []
-        words = []
-        
-        # First item can be the prefix
-        if items and items[0] in '. % %% %%% ! !! !!! ? ?? ???':
-            prefix = items.pop(0)
-        
-        # Next are either words or tags
-        for item in items:
-            if item.startswith('#'):
-                tags.append(item)
-            else:
-                words.append(item)
-        
-        # Done
-        return prefix, tags, words
+        return parseSelection(self._main._select.text())[:3]
         
     
     def _selectNotes(self):
         """ Turn notes visible or not, depending on the selection box.
         """
-        # Get selection
-        prefix, tags, words = self.currentSelection()
-        
-        # Collect tags
-        self._allTags = allTags = set()
-        self._selectedTags = selectedTags = set()
-        
-        # process prefix: Select all notes with the given prefix, or
-        # select all but hidden notes
-        selection1 = []
-        if prefix:
-            selection1 = [note for note in self._collection 
-                                        if note.prefix.startswith(prefix)]
-        else:
-            selection1 = [note for note in self._collection 
-                                        if note.prefix != '.']
+        from .app import config
         
-        [allTags.update(n.tags) for n in selection1]
+        # Select all notes with the given prefix (or all but hidden notes),
+        # and the given tags and words. These are already sorted (by
+        # relevance if ranked search is enabled).
+        selection2 = self._collection.find(self._main._select.text(),
+                                           config['rankedsearch'])
         
-        # Search for tags and words
-        if not (tags or words):
-            selection2 = selection1
-        else:
-            selection2 = []
-            for note in selection1:
-                showNote = True
-                for item in tags:
-                    if item == '#':
-                        if note.tags:
-                            showNote = False
-                    elif item not in note.tags:
-                        showNote = False
-                for item in words:
-                    if item not in note.words and ('#' + item) not in note.tags:
-                        showNote = False
-                if showNote:
-                    selection2.append(note)
-        
-        [selectedTags.update(n.tags) for n in selection2]
-        
-        # Update selection box
-        self._main._tagsCompleter.setWords(allTags)
+        # Update selection box, but only when a tag is being typed, because
+        # collecting the tags needs the index (i.e. all notes parsed)
+        if self._main._select.text().split(' ')[-1].startswith('#'):
+            self._main._tagsCompleter.setWords(self.allTags())
         #self._main._tagsCompleter.setWordsToIgnore(tags)
         
-        # Sort
-        selection2.sort(key=lambda x: x.created, reverse=True)
-        if prefix:
-            selection2.sort(key=lambda x: x.priority, reverse=True)
         return selection2
     
     
+    def allTags(self):
+        """ Get the tags of the notes with the selected prefix (or of all
+        but hidden notes). These are collected again only if the prefix or
+        the collection has changed.
+        """
+        prefix = self.currentSelection()[0]
+        key = id(self._collection), self._collection.generation, prefix
+        if self._allTagsKey != key:
+            self._allTags = self._collection.allTags(prefix)
+            self._allTagsKey = key
+        return self._allTags
+    
+    
     def _showNotes(self):
         
-        noteToFocus = None
+        notes = self._notesToShow.page(self._notesShown, self._notesShown + 16)
+        self._notesShown += len(notes)
         
-        for i in range(16):
-            if not self._notesToShow_pending:
-                break
-            
-            note = self._notesToShow_pending.pop(0)
+        for note in notes:
             
             noteDisplay = NoteDisplay(self, note)
             #self.layout().insertWidget(len(self._noteDisplays), noteDisplay, 0)
             self.layout().addWidget(noteDisplay, 0)
             self._noteDisplays.append(noteDisplay)
-            noteToFocus = noteToFocus or noteDisplay
         
-        self._stopper.setMinimumHeight(20*len(self._notesToShow_pending)+20)
+        self._updateStopper()
+    
+    
+    def _updateStopper(self):
+        # Notes are selected as they are shown, so we do not know how
+        # many are pending; make room for one more page if there are any.
+        pending = self._notesToShow.hasMore(self._notesShown)
+        self._stopper.setMinimumHeight(20*16*pending+20)
         self.layout().addWidget(self._stopper, 1)
         
         if not self._notesToShow:
             self._stopper.setText('no notes to display')
-        elif self._notesToShow_pending:
+        elif pending:
             self._stopper.setText('loading notes ...')
         else:
             self._stopper.setText('')
     
     
     def _checkNeedMoreDisplays(self):
-        if self._notesToShow_pending:
+        if self._notesToShow and self._notesToShow.hasMore(self._notesShown):
             top = self._stopper.pos().y()  #self._stopper.rect().top()
             bottom = self.visibleRegion().boundingRect().bottom()
             if bottom > top:
@@ -417,7 +449,7 @@ class NoteDisplay(QtWidgets.QFrame):
             
             self._editor = ScalingEditor(self)
             #
-            self._tagsCompleter = app.TagCompleter(self._editor, self.parent()._allTags)
+            self._tagsCompleter = app.TagCompleter(self._editor, self.parent().allTags())
             self._editor.setCompleter(self._tagsCompleter)
             #
             self._editor.textChanged.connect(self.updateLabel)
@@ -430,8 +462,13 @@ class NoteDisplay(QtWidgets.QFrame):
             self._editor.setFont(font)
             #self._editor.focusOutEvent = lambda ev: self._collapseOrExpand()
     
+    def isExpanded(self):
+        """ Get whether the editor of this note is shown.
+        """
+        return bool(self._editor and self._editor.isVisible())
+    
     def _collapseOrExpand(self):
-        if self._editor and self._editor.isVisible():
+        if self.isExpanded():
             self.collapseNote()
         else:
             self.expandNote()
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" notes.noteindex
+This module implements an inverted index for the tags and words of the
+notes in a collection. Each term maps to the set of ids of the notes that
+contain it, so that a query is answered by intersecting these sets,
+instead of checking every note. The terms are also kept in a sorted list,
+so that a prefix can be expanded to the matching terms by bisection.
+Matches can be ranked by relevance using BM25.
+"""
+
+import math
+import heapq
+from bisect import bisect_left, insort
+
+# Sorts after any character that a term may contain
+MAXCHAR = '\U0010ffff'
+
+# Checking the terms of a note is this much slower than adding an id to
+# a set. Used to decide whether to intersect or to filter.
+_FILTER_COST = 2
+
+# Parameters for BM25: saturation of term frequency, length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+class InvertedIndex:
+    """ Inverted index that maps tags and words to note ids. The index
+    is built on first use, because that requires parsing the text of all
+    notes. Once built, it is kept up to date via add() and remove().
+    """
+
+    # The tags and words of the indexed notes are parsed and kept in memory
+    # (so filtering notes by their tags and words is cheap).
+    keepsTokens = True
+
+    def __init__(self):
+        self.built = False
+        self._postings = {}  # term -> set of note ids
+        self._terms = {}  # note id -> terms of that note
+        self._untagged = set()  # ids of notes without tags
+        self._sortedTerms = []
+        self._nterms = 0  # Sum of the number of terms of all notes
+        self._lengths = {}  # note id -> number of tags and words
+        self._totalLength = 0
+
+    def __len__(self):
+        return len(self._terms)
+
+    def build(self, notes):
+        """ Build the index for the given notes.
+        """
+        self.built = True
+        self._postings = {}
+        self._terms = {}
+        self._untagged = set()
+        self._sortedTerms = None  # Sort once at the end
+        self._nterms = 0
+        self._lengths = {}
+        self._totalLength = 0
+        for note in notes:
+            self.add(note)
+        self._sortedTerms = sorted(self._postings)
+
+    def add(self, note):
+        """ Add or update the terms for the given note. Does nothing if
+        the index is not built.
+        """
+        if not self.built:
+            return
+        id = note.id
+        tags = note.tags
+        terms = tags | note.words
+        oldTerms = self._terms.get(id, ())
+        postings = self._postings
+        for term in oldTerms:
+            if term not in terms:
+                self._discard(term, id)
+        for term in terms:
+            if term not in oldTerms:
+                try:
+                    postings[term].add(id)
+                except KeyError:
+                    postings[term] = {id}
+                    if self._sortedTerms is not None:
+                        insort(self._sortedTerms, term)
+        self._terms[id] = terms
+        self._nterms += len(terms) - len(oldTerms)
+        self._totalLength += note._length - self._lengths.get(id, 0)
+        self._lengths[id] = note._length
+        if tags:
+            self._untagged.discard(id)
+        else:
+            self._untagged.add(id)
+
+    def remove(self, id):
+        """ Remove the note with the given id from the index.
+        """
+        terms = self._terms.pop(id, ())
+        for term in terms:
+            self._discard(term, id)
+        self._nterms -= len(terms)
+        self._totalLength -= self._lengths.pop(id, 0)
+        self._untagged.discard(id)
+
+    def commit(self):
+        """ Nothing to commit; for compatibility with the SqlIndex.
+        """
+        pass
+
+    def close(self):
+        """ Nothing to release; for compatibility with the SqlIndex.
+        """
+        pass
+
+    def tags(self, ids=None):
+        """ Get the set of all tags in the index, or of the notes with
+        the given ids.
+        """
+        if ids is None:
+            return set(self.expand('#'))
+        terms = self._terms
+        return {term for id in ids for term in terms.get(id, ()) if term.startswith('#')}
+
+    def expand(self, prefix):
+        """ Get the terms that start with the given prefix.
+        """
+        terms = self._sortedTerms
+        i = bisect_left(terms, prefix)
+        j = bisect_left(terms, prefix + MAXCHAR, i)
+        return terms[i:j]
+
+    def lookup(self, tags, words):
+        """ Get the set of ids of the notes that have all the given tags,
+        and all the given words (either as word or as tag). Tags and words
+        match all terms that they are a prefix of. The tag '#' matches
+        notes that have no tags.
+        """
+        postings = self._postings
+        # Get the matching terms and the number of ids for each item
+        items = []
+        for tag in tags:
+            if tag == '#':
+                items.append((len(self._untagged), None, None))
+            else:
+                terms = self.expand(tag)
+                items.append((sum(len(postings[t]) for t in terms), (tag, ), terms))
+        for word in words:
+            terms = self.expand(word) + self.expand('#' + word)
+            items.append((sum(len(postings[t]) for t in terms), (word, '#' + word), terms))
+        if not items:
+            return set(self._terms)
+        # Start with the item with the fewest ids. For the other items,
+        # intersect with their ids, or check the terms of each note in
+        # the result if that is less work (e.g. for short prefixes).
+        items.sort(key=lambda item: item[0])
+        filterCost = _FILTER_COST * self._nterms / max(1, len(self._terms))
+        result = None
+        for size, prefixes, terms in items:
+            if result is None:
+                result = self._ids(terms)
+            elif not result:
+                break
+            elif size > filterCost * len(result):
+                if prefixes is None:
+                    result = {id for id in result if id in self._untagged}
+                else:
+                    allTerms = self._terms
+                    result = {id for id in result
+                              if any(t.startswith(prefixes) for t in allTerms[id])}
+            else:
+                result &= self._ids(terms)
+        return result
+
+    def rank(self, notes, words, limit):
+        """ Get the (at most) limit notes that match the given words best,
+        sorted by their BM25 score. Words match the terms that they are
+        a prefix of. Notes with equal scores keep their order.
+        """
+        postings = self._postings
+        n = max(1, len(self._terms))
+        avgLength = self._totalLength / n or 1.0
+        prefixes = [(word, '#' + word) for word in words]
+        allTerms = self._terms
+        idfs = {}
+        
+        def score(note):
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * note._length / avgLength)
+            counts = note._counts
+            total = 0.0
+            for term in allTerms[note.id]:
+                for prefix in prefixes:
+                    if term.startswith(prefix):
+                        idf = idfs.get(term)
+                        if idf is None:
+                            df = len(postings[term])
+                            idf = idfs[term] = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                        tf = counts.get(term, 1)
+                        total += idf * tf * (BM25_K1 + 1) / (tf + norm)
+            return total
+        
+        return heapq.nlargest(limit, notes, key=score)
+
+    def _ids(self, terms):
+        # Get a new set with the ids of the notes that have any of the terms
+        if terms is None:
+            return set(self._untagged)
+        postings = self._postings
+        ids = set()
+        for term in terms:
+            ids.update(postings[term])
+        return ids
+
+    def _discard(self, term, id):
+        ids = self._postings[term]
+        ids.discard(id)
+        if not ids:
+            del self._postings[term]
+            terms = self._sortedTerms
+            i = bisect_left(terms, term)
+            del terms[i]
@@ -11,6 +11,13 @@ import sys
 import datetime
 import random
 import hashlib
+from array import array
+
+from . import parsecache
+from .notewriter import NoteWriter
+from .headercodec import (NEVER, decodeHeader, decodeHeaders, decodeCreated,
+                          decodeModified, encodeHeader, textId,
+                          formatCreated, toEpoch, fromEpoch)
 
 
 # def str_to_int(s):
@@ -21,6 +28,201 @@ import hashlib
 #     return bignum
 
 
+_WHITESPACE = b' \t\n\r\x0b\x0c'
+
+def splitNotes(buffer):
+    """ Split the bytes of a notes file in a single scan. Returns a list
+    of (header, start, end) tuples, in which header is the decoded header
+    without the '----', and start and end mark the stripped text of the
+    note in the buffer. Completely empty notes are skipped.
+    """
+    result = []
+    find = buffer.find
+    n = len(buffer)
+    i0 = 0
+    while i0 <= n:
+        i1 = find(b'\n----', i0)
+        if i1 < 0:
+            i1 = n
+        # Split header and text
+        start = find(b'\n', i0, i1)
+        if start < 0:
+            start = end = i1
+        else:
+            end = i1
+        header = buffer[i0:start].decode('utf-8', 'ignore').strip().strip('-')
+        # Strip the text, without copying it
+        while start < end and buffer[start] in _WHITESPACE:
+            start += 1
+        while end > start and buffer[end-1] in _WHITESPACE:
+            end -= 1
+        if header or start < end:  # Skip completely empty notes
+            result.append((header, start, end))
+        i0 = i1 + 5
+    return result
+
+
+def getPrefix(text):
+    """ Get the prefix of a note from its text (or the start of it).
+    """
+    # Get the first non-empty line without splitting the whole text
+    start, title = 0, ''
+    while not title and start < len(text):
+        end = text.find('\n', start)
+        if end < 0:
+            end = len(text)
+        title = text[start:end].strip()
+        start = end + 1
+    
+    prefix = title.split(' ', 1)[0]
+    if prefix.startswith('.'):
+        return '.'  # hidden
+    elif not (prefix and prefix in '! !! !!! ? ?? ??? % % %%%'):
+        return '%'  # Default is a normal note
+    return prefix
+
+
+def parseText(text):
+    """ Get the title, tags and words of the given text. Returns a tuple
+    (title, tags, words, counts, length), in which counts has the number
+    of occurrences of the tags and words that occur more than once, and
+    length is the total number of tags and words.
+    """
+    title = ''
+    tags = set()
+    words = set()
+    counts = {}  # Only for tags and words that occur more than once
+    length = 0
+    
+    for line in text.splitlines():
+        if not title:
+            title = line.strip()
+        for word in line.split(' '):
+            word = word.lower().strip()
+            if word.startswith('#'):
+                if len(word) >= 3 and word[1:].isalnum():
+                    if word in tags:
+                        counts[word] = counts.get(word, 1) + 1
+                    tags.add(word)
+                    length += 1
+            elif word.isalnum():
+                if word in words:
+                    counts[word] = counts.get(word, 1) + 1
+                words.add(word)
+                length += 1
+    
+    return title, tags, words, counts, length
+
+
+def randomId():
+    """ Get a random id, for notes that have no id and no text.
+    """
+    print('created random id')
+    return ''.join([random.choice('0123456789abcdef') for c in range(40)])
+
+
+def parseFile(filename):
+    """ Parse the notes in the given file into records, without creating
+    Note objects. Returns (modtime, size, records). The result can be
+    pickled, so that files can be parsed in another process.
+    """
+    modtime = os.path.getmtime(filename)
+    with open(filename, 'rb') as f:
+        buffer = f.read()
+    chunks = splitNotes(buffer)
+    fieldsList = decodeHeaders([chunk[0] for chunk in chunks])
+    
+    records = dict(headers=[], ids=[], modified=[], prefixes=[],
+                   titles=[None] * len(chunks), tags=[None] * len(chunks),
+                   words=[None] * len(chunks), counts=[None] * len(chunks),
+                   lengths=[0] * len(chunks))
+    spans, created, fps, deleted = array('q'), array('q'), [], []
+    for (header, start, end), fields in zip(chunks, fieldsList):
+        id, dt, createdStr, modified, isDeleted = fields
+        raw = buffer[start:end]
+        if id is None:
+            text = raw.decode('utf-8', 'ignore').strip()
+            id = textId(text + '\n') if text else randomId()
+        records['headers'].append(header)
+        records['ids'].append(id)
+        records['modified'].append(modified)
+        records['prefixes'].append(getPrefix(
+            raw[:64].decode('utf-8', 'ignore').lstrip() or 
+            raw.decode('utf-8', 'ignore')))
+        spans.extend((start, end))
+        created.append(toEpoch(dt))
+        fps.append(fingerprint(header, raw))
+        deleted.append(isDeleted)
+    records['spans'] = spans.tobytes()
+    records['created'] = created.tobytes()
+    records['fingerprints'] = b''.join(fps)
+    records['deleted'] = bytes(deleted)
+    records['nentries'] = len(chunks)
+    return modtime, len(buffer), records
+
+
+def isNoteFile(filename):
+    """ Get whether the given file is a note file, i.e. is named like
+    notes.<computername>.txt.
+    """
+    basename = os.path.basename(filename)
+    return basename.count('.') >= 2 and basename.endswith('.txt')
+
+
+def isSegment(filename):
+    """ Get whether the given note file is a sealed segment, i.e. is
+    named like notes.<computername>.seg<NNNN>.txt.
+    """
+    parts = os.path.basename(filename).split('.')
+    return (len(parts) >= 4 and parts[-2].startswith('seg') and
+            len(parts[-2]) >= 7 and parts[-2][3:].isdigit())
+
+
+def segmentName(filename, number):
+    """ Get the filename for the segment with the given number of
+    the given (active) note file.
+    """
+    return '%s.seg%04i.txt' % (filename[:-4], number)
+
+
+def segmentNumber(filename):
+    """ Get the number of the given segment.
+    """
+    return int(os.path.basename(filename).split('.')[-2][3:])
+
+
+def latestVersions(notes):
+    """ Get a list with only the latest version of each note.
+    """
+    latest = {}
+    for note in notes:
+        curNote = latest.get(note.id, None)
+        # A deletion wins from a version with the same time
+        if curNote is None or ((note.modifiedStr, note.deleted) >=
+                               (curNote.modifiedStr, curNote.deleted)):
+            latest[note.id] = note
+    return list(latest.values())
+
+
+def fingerprint(header, text):
+    """ Get a fingerprint for the given note, with header a str (as
+    returned by splitNotes) and text the bytes of the stripped text.
+    """
+    h = hashlib.sha1(header.encode('utf-8'))
+    h.update(b'\n')
+    h.update(text)
+    return h.digest()
+
+
+def entryText(text, raw):
+    """ Get the text to write for a note, given its text or (if the text
+    has not been decoded) its raw bytes.
+    """
+    if text is None:
+        return raw.tobytes().decode('utf-8', 'ignore').strip() + '\n'
+    return text
+
+
 class Note:
     """ Representation of a note plus convenience stuff such
     as getting tags etc.
@@ -35,21 +237,44 @@ class Note:
       * priority - len(prefix)
       * tags - set of tags present in this note (all lowercase)
       * words - set of words present in this note (all lowercase)
+      * deleted - whether this note is a tombstone that marks a deletion
     
+    By default a note is lazy: only the id, created date and prefix are
+    determined on creation. The title, tags, words and modified date
+    are parsed the first time that they are used.
     """
     
-    __slots__ = ['_fileProxy', '_header', '_text', '_text0', 
-                'id', '_created', '_createdStr', '_modified', '_modifiedStr',
-                'title', 'tags', 'words', 'prefix']
+    __slots__ = ['_fileProxy', '_header', '_text', '_text0', '_raw', '_span',
+                '_fingerprint', 'id', 'deleted', '_created', '_createdStr', 
+                '_modified', '_modifiedStr', '_modifiedRaw',
+                '_title', '_tags', '_words', '_counts', '_length', '_tokens',
+                'prefix']
    
-    def __init__(self, fileProxy, header, text):
+    def __init__(self, fileProxy, header, text, lazy=True, fields=None, raw=None,
+                 parsed=None):
         self._fileProxy = fileProxy
         self._header = header  # Header without the '----'
-        self._text = text
+        self._text = text  # If None, it is decoded from raw when needed
         self._text0 = text
+        self._raw = raw
+        self._span = None  # (start, end) of the text in the file
+        self._fingerprint = None  # fingerprint of the note on disk
+        self._title = self._tags = self._words = self._counts = None
+        self._length = 0  # Number of tags and words in the text
+        self._tokens = None  # (getTokens, i) to get parsed tokens from elsewhere
         #
-        self._parseHeader()
-        self._parseText()
+        self._parseHeader(fields)
+        if parsed is None:
+            self._parsePrefix()
+        else:
+            # Restore (partially) parsed info, e.g. from a cache
+            self.prefix, self._title, tags, words, counts, length = parsed
+            if tags is not None:
+                self._setTokens(set(tags), set(words), counts, length)
+        # In lazy mode, title, tags, words and modified are parsed on demand
+        if not lazy:
+            self._parseModified()
+            self._parseText()
     
 #     def __eq__(self, other):
 #         return self.id == other.id
@@ -61,25 +286,35 @@ class Note:
     
     @property
     def text(self):
+        if self._text is None:
+            self._text = self._text0 = self._decodeRaw()
         return self._text
     
     def setText(self, text):
         text = text.replace('\n----', '\n ----')
         self._text = text
-        self._parseText()
+        self._parsePrefix()
+        self._title = self._tags = self._words = self._counts = None
+        self._tokens = None
+        self._notifyChanged()
     
     def setCreatedStr(self, text):
-        self._createdStr = text
+        self._created, self._createdStr = decodeCreated(text)
         self._generateHeader()
     
     def setModifiedStr(self, text):
-        self._modifiedStr = text
+        self._modifiedRaw = text
+        self._modified = None
         self._generateHeader()
     
     def _generateHeader(self):
-        self._header = 'id:%s, c:%s, m:%s' % (
-                        self.id, self._createdStr, self._modifiedStr)
-        self._parseHeader()
+        modifiedStr = self.modifiedStr
+        self._header = encodeHeader(self.id, self._createdStr, modifiedStr)
+        # No need to parse the header; just make modified follow created
+        # again if it is not a valid date.
+        self._modifiedRaw = modifiedStr
+        self._modified = None
+        self._notifyChanged()
     
     # Derived properties
     
@@ -99,20 +334,56 @@ class Note:
     def modfied(self):
         """ Datetime representation of this note. Use for selection and sorting.
         """
+        if self._modified is None:
+            self._parseModified()
         return self._modified
     
     @property    
     def modifiedStr(self):
         """ Date string for this note.
         """
+        if self._modified is None:
+            self._parseModified()
         return self._modifiedStr
     
+    @property
+    def title(self):
+        """ The first line of the text, stripped.
+        """
+        if self._title is None:
+            self._parseText()
+        return self._title
+    
+    @property
+    def tags(self):
+        """ Set of tags present in this note (all lowercase).
+        """
+        if self._tags is None:
+            self._parseText()
+        return self._tags
+    
+    @property
+    def words(self):
+        """ Set of words present in this note (all lowercase).
+        """
+        if self._words is None:
+            self._parseText()
+        return self._words
+    
     @property
     def priority(self):
         """ For tasks, the priority of the task/note/idea.
         """
         return len(self.prefix)
     
+    def count(self, token):
+        """ Get the number of times that the given tag or word occurs
+        in the text.
+        """
+        if token in self.words or token in self.tags:
+            return self._counts.get(token, 1)
+        return 0
+    
     # Management
     
     def save(self, force=False):
@@ -127,101 +398,102 @@ class Note:
                 self._fileProxy = self._fileProxy.mainPoxy
                 self._fileProxy._notes.append(self)
             # Save
-            self._fileProxy.save()
+            self._fileProxy.save(self)
+            self._text0 = self._text
+            self._notifyChanged()
     
     def delete(self):
-        """ Delete the note.
+        """ Delete the note. A tombstone is saved to the file of this
+        device, so that the deletion propagates to other devices. Unless
+        in append-only mode, the note is also removed from its file. The
+        tombstone keeps the text, so that older versions of the app (which
+        do not know tombstones) keep showing the note as it was.
         """
-        self._fileProxy._notes.remove(self)
-        self._fileProxy.save()
+        fileProxy = self._fileProxy
+        mainProxy = fileProxy.mainPoxy or fileProxy
+        appendOnly = mainProxy.appendOnly
+        if fileProxy is mainProxy or not (appendOnly or fileProxy.sealed):
+            fileProxy._notes.remove(self)
+            if fileProxy._latest.get(self.id, None) is self:
+                del fileProxy._latest[self.id]
+            if fileProxy is not mainProxy:
+                fileProxy.save()
+        now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        header = encodeHeader(self.id, self._createdStr, now, True)
+        tombstone = Note(mainProxy, header, self.text)
+        mainProxy._notes.append(tombstone)
+        mainProxy.save(tombstone)
+        tombstone._notifyChanged()
     
     # Private 
     
-    def _parseHeader(self):
-        header = self._header.strip(' \t\n\r-:')
-        created = ''
-        modified = ''
-        id = None
-        
-        # Parse the header
-        for part in header.split(','):
-            key, colon, value = part.partition(':')
-            key, value = key.strip(), value.strip()
-            #
-            if key == 'id':
-                id = value
-            elif key in ('c', 'created'):
-                created = value
-            elif key in ('m', 'modified'):
-                modified = value
-            elif part:
-                created = part
+    def _notifyChanged(self):
+        collection = self._fileProxy.collection
+        if collection is not None:
+            collection._noteChanged(self)
+    
+    def _parseHeader(self, fields=None):
+        if fields is None:
+            fields = decodeHeader(self._header)
+        id, self._created, self._createdStr, self._modifiedRaw, self.deleted = fields
         
         # Process id
         if id is None:
-            if self._text.strip():
+            if self.text.strip():
                 #id = hash(self._text) # doh, Python 3 has hash randomizatipn :)
-                id = hashlib.sha256(self._text.encode('utf-8')).hexdigest()
+                id = textId(self._text)
             else:
-                print('created random id')
                 #id = random.randint(-sys.maxsize, sys.maxsize)
-                id = ''.join([random.choice('0123456789abcdef') for c in range(40)])
+                id = randomId()
         self.id = id
         
-        # Parse date and time for created
-        self._created = datetime.datetime(9000, 1, 1) # In the future (only for sorting)
-        self._createdStr = ''
-        for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%Y%m%d']:
-            try:
-                self._created = datetime.datetime.strptime(created, fmt)
-                self._createdStr = self._created.strftime('%Y-%m-%d')#('%x')
-                break
-            except ValueError:
-                pass
-        
-         # Parse date and time for modified
-        self._modified = self._created
+        # Modified is parsed on demand
+        self._modified = None
         self._modifiedStr = ''
-        for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%Y%m%d']:
-            try:
-                self._modified = datetime.datetime.strptime(modified, fmt)
-                self._modifiedStr = self._modified.strftime('%Y-%m-%d %H:%M:%S')#('%x')
-                break
-            except ValueError:
-                pass
     
+    def _parseModified(self):
+        self._modified, self._modifiedStr = decodeModified(self._modifiedRaw,
+                                                           self._created)
+    
+    def _decodeRaw(self):
+        text = entryText(None, self._raw)
+        self._raw = None  # Release our part of the file buffer
+        return text
     
+    def _parsePrefix(self):
+        # If not yet decoded, the start of the text is enough to get it
+        text = self._text
+        if text is None:
+            text = self._raw[:64].tobytes().decode('utf-8', 'ignore').lstrip()
+            if not text:
+                text = self.text
+        self.prefix = getPrefix(text)
     
     def _parseText(self):
-        
-        # Find title, tasks and tags
-        title = ''
-        tasks = []
-        tags = set()
-        words = set()
-        
-        for line in self._text.splitlines():
-            if not title:
-                title = line.strip()
-            for word in line.split(' '):
-                word = word.lower().strip()
-                if word.startswith('#'):
-                    if len(word) >= 3 and word[1:].isalnum():
-                        tags.add(word)
-                elif word.isalnum():
-                    words.add(word)
-        
+        if self._tokens is not None:
+            # The tokens were parsed before (e.g. stored in a snapshot)
+            getTokens, i = self._tokens
+            self._tokens = None
+            self._tags, self._words, self._counts, self._length = getTokens(i)
+            return
+        title, tags, words, counts, length = parseText(self.text)
         # Cache this info
-        self.title = title
-        self.tags = tags
-        self.words = words
-        
-        # Store prefix
-        self.prefix = self.title.split(' ', 1)[0]
-        if self.prefix.startswith('.'):
-            self.prefix = '.'  # hidden
-        elif not (self.prefix and self.prefix in '! !! !!! ? ?? ??? % % %%%'):
-            self.prefix = '%'  # Default is a normal note
+        self._title = title
+        self._setTokens(tags, words, counts, length)
+    
+    def _setTokens(self, tags, words, counts, length):
+        # Use the shared vocabulary of the collection, if there is one
+        collection = self._fileProxy.collection
+        if collection is not None:
+            intern = collection.vocabulary.intern
+            tags = {intern(tag) for tag in tags}
+            words = {intern(word) for word in words}
+            counts = {intern(token): n for token, n in counts.items()}
+        self._tags = tags
+        self._words = words
+        self._counts = counts
+        self._length = length
+
     
     
 
@@ -230,55 +502,373 @@ class FileProxy:
     """ Representation of a file containing notes. 
     This class is responsible for loading the notes from the file,
     saving the notes back to file, and keeping track of updates.
+    If background is True, saves are written by a NoteWriter in a
+    worker thread. A sealed file (an older segment of the file of a
+    device) is not written to, but it is checked for changes like any
+    other file, because it may still be synced from another device.
     """
     
-    def __init__(self, filename, mainPoxy=None):
+    def __init__(self, filename, mainPoxy=None, cacheDir=None, collection=None,
+                 appendOnly=False, background=False, sealed=False):
         self.mainPoxy = mainPoxy
+        self.collection = collection
+        self.appendOnly = appendOnly
+        self.sealed = sealed
         self._filename = filename
+        self._cacheDir = cacheDir
+        self._writer = NoteWriter(self) if background else None
         self._modtime = 0
-        self._notes = []
+        self._size = None  # Size of the file as we know it, if known
+        self._notes = []  # The latest version of each note
+        self._latest = {}  # id -> latest version, i.e. which notes we own
+        self._fingerprints = {}  # fingerprint -> Note, as on disk
+        self._nentries = 0  # Number of notes on disk, including old versions
+        self._cacheState = None  # What the cache describes, see _getCacheState()
     
     def hasChanged(self):
-        """ Get whether the file was changed from the outside.
+        """ Get whether the file was changed (or removed) from the outside.
         """
-        return self._modtime != os.path.getmtime(self._filename)
+        if self._writer is not None and self._writer.pending():
+            return False  # Our own changes are not written yet
+        try:
+            st = os.stat(self._filename)
+        except OSError:
+            return bool(self._modtime)  # Removed since we loaded it
+        return (self._modtime != st.st_mtime or
+                (self._size is not None and self._size != st.st_size))
     
     def currentNotes(self):
         return self._notes
     
-    def getNotes(self):
-        notes = []
+    def needsFullParse(self):
+        """ Get whether getNotes() needs to parse the whole file, i.e.
+        whether the notes are not loaded yet and not in the cache. A file
+        that has been removed needs no parsing.
+        """
+        if self._fingerprints:
+            return False
+        try:
+            st = os.stat(self._filename)
+        except OSError:
+            return False  # Removed; getNotes() handles that
+        if self._cacheDir:
+            return not parsecache.isCached(self._cacheDir, self._filename,
+                                           st.st_size, st.st_mtime)
+        return True
+    
+    def getNotes(self, parsed=None):
+        """ Load the notes from the file. If given, parsed is the result
+        of parseFile() for this file (e.g. obtained in another process).
+        """
+        self.flush()
         
+        # The file may have been removed (e.g. after consolidating)
+        if not os.path.isfile(self._filename):
+            self._modtime = self._nentries = 0
+            self._size = None
+            self._notes, self._latest, self._fingerprints = [], {}, {}
+            return []
+        
+        # Read the file in one go. The text of each note is decoded
+        # when it is needed.
+        modtime = os.path.getmtime(self._filename)
         with open(self._filename, 'rb') as f:
-            alltext = f.read().decode('utf-8', 'ignore')
-            for text in alltext.split('\n----'):
-                try:
-                    header, text = text.split('\n', 1)
-                except ValueError:
-                    header, text = text, ''
-                header = header.strip().strip('-')
-                text = text.strip()
-                if header or text: # Skip completely empty notes
-                    notes.append(Note(self, header, text+'\n'))
+            buffer = f.read()
+        view = memoryview(buffer)
+        
+        # Use given records if they match, otherwise try the cache at startup
+        records = None
+        fromCache = False
+        startup = not self._fingerprints
+        if parsed is not None and parsed[:2] == (modtime, len(buffer)):
+            records = parsed[2]
+        elif self._cacheDir and startup:
+            records = parsecache.loadCache(self._cacheDir, self._filename,
+                                           buffer, modtime)
+            fromCache = records is not None
+        
+        # Get notes
+        if records is not None:
+            notes = self._notesFromRecords(view, records)
+        else:
+            notes = self._notesFromChunks(view, splitNotes(buffer))
         
         # Done
-        self._modtime = os.path.getmtime(self._filename)
-        self._notes = notes
+        self._modtime = modtime
+        self._size = len(buffer)
+        # Records may leave out superseded versions, but count them
+        self._nentries = len(notes) if records is None else records['nentries']
+        self._notes = notes = latestVersions(notes)
+        self._latest = {note.id: note for note in notes}
+        # Write the cache after parsing at startup; after a reload it is
+        # written by saveCache(), so not on each change of the file.
+        if fromCache:
+            self._cacheState = self._getCacheState()
+        elif self._cacheDir and startup:
+            parsecache.saveCache(self._cacheDir, self._filename, 
+                                 buffer, modtime, self._records())
+            self._cacheState = self._getCacheState()
         return notes
     
+    def _notesFromChunks(self, view, chunks):
+        # Notes that have not changed on disk are reused, the rest is
+        # decoded. Headers are decoded in one go.
+        notes = []
+        fingerprints = {}
+        oldFingerprints = self._fingerprints
+        newChunks = []
+        for chunk in chunks:
+            header, start, end = chunk
+            fp = fingerprint(header, view[start:end])
+            note = oldFingerprints.pop(fp, None)
+            if note is not None and note._fileProxy is self and note._header == header:
+                if note._text is None:
+                    note._raw = view[start:end]  # Release the old buffer
+                if note._text0 == note._text:  # Not changed in the meantime
+                    note._span = start, end
+                    note._fingerprint = fp
+                    fingerprints[fp] = note
+                    notes.append(note)
+                    continue
+            fingerprints[fp] = None
+            notes.append(None)
+            newChunks.append((len(notes) - 1, fp, chunk))
+        #
+        headers = [chunk[2][0] for chunk in newChunks]
+        for (i, fp, (header, start, end)), fields in zip(newChunks, decodeHeaders(headers)):
+            if start < end:
+                note = Note(self, header, None, fields=fields, raw=view[start:end])
+            else:
+                note = Note(self, header, '\n', fields=fields)
+            note._span = start, end
+            note._fingerprint = fp
+            notes[i] = fingerprints[fp] = note
+        
+        self._fingerprints = fingerprints
+        return notes
+    
+    def _notesFromRecords(self, view, records):
+        # Create notes from (cached) records, without parsing anything
+        notes = []
+        fingerprints = {}
+        spans = array('q', records['spans'])
+        fps = records['fingerprints']
+        createdStrs = {toEpoch(NEVER): (NEVER, '')}
+        for i, (header, id, created, modified, deleted, parsed) in enumerate(zip(
+                records['headers'], records['ids'], array('q', records['created']),
+                records['modified'], records['deleted'],
+                zip(records['prefixes'], records['titles'],
+                    records['tags'], records['words'],
+                    records['counts'], records['lengths']))):
+            start, end = spans[2*i], spans[2*i+1]
+            if created not in createdStrs:
+                dt = fromEpoch(created)
+                createdStrs[created] = dt, formatCreated(dt)
+            fields = (id, ) + createdStrs[created] + (modified, bool(deleted))
+            if start < end:
+                note = Note(self, header, None, fields=fields, raw=view[start:end],
+                            parsed=parsed)
+            else:
+                note = Note(self, header, '\n', fields=fields, parsed=parsed)
+            note._span = start, end
+            note._fingerprint = fps[20*i:20*i+20]
+            notes.append(note)
+            fingerprints[note._fingerprint] = note
+        
+        self._fingerprints = fingerprints
+        return notes
+    
+    def _records(self):
+        # Get the records that describe the notes as they are on disk
+        records = dict(headers=[], ids=[], modified=[], prefixes=[],
+                       titles=[], tags=[], words=[], counts=[], lengths=[])
+        spans, created, fps, deleted = array('q'), array('q'), [], []
+        for fp, note in self._fingerprints.items():
+            if note._fingerprint != fp or note._fileProxy is not self:
+                continue  # This version has been superseded
+            records['headers'].append(note._header.strip().strip('-'))
+            records['ids'].append(note.id)
+            records['modified'].append(note._modifiedRaw)
+            # A note that has been edited (but not saved) is described
+            # as it is on disk, so without what was parsed from the edit
+            onDisk = note._text is None or note._text == note._text0
+            if onDisk:
+                records['prefixes'].append(note.prefix)
+            else:
+                text0 = entryText(None, note._raw) if note._text0 is None else note._text0
+                records['prefixes'].append(getPrefix(text0))
+            if note._tags is None or not onDisk:
+                records['titles'].append(None)
+                records['tags'].append(None)
+                records['words'].append(None)
+                records['counts'].append(None)
+                records['lengths'].append(0)
+            else:
+                records['titles'].append(note._title)
+                records['tags'].append(tuple(note._tags))
+                records['words'].append(tuple(note._words))
+                records['counts'].append(note._counts)
+                records['lengths'].append(note._length)
+            spans.extend(note._span)
+            created.append(toEpoch(note._created))
+            fps.append(fp)
+            deleted.append(note.deleted)
+        records['spans'] = spans.tobytes()
+        records['created'] = created.tobytes()
+        records['fingerprints'] = b''.join(fps)
+        records['deleted'] = bytes(deleted)
+        records['nentries'] = self._nentries  # Including superseded versions
+        return records
+    
+    def _getCacheState(self):
+        # The file as we know it, and how many notes have been parsed
+        nparsed = sum(note is not None and note._tags is not None
+                      for note in self._fingerprints.values())
+        return self._modtime, self._size, nparsed
+    
+    def saveCache(self):
+        """ Store what we know about the notes in the cache (if this proxy
+        has a cache dir). Also stores the tags and words of the notes that
+        have been parsed since the cache was written. Does nothing if the
+        cache is up to date.
+        """
+        self.flush()
+        if not (self._cacheDir and self._modtime):
+            return
+        state = self._getCacheState()
+        if state != self._cacheState and not self.hasChanged():
+            with open(self._filename, 'rb') as f:
+                buffer = f.read()
+            parsecache.saveCache(self._cacheDir, self._filename, 
+                                 buffer, self._modtime, self._records())
+            self._cacheState = state
+    
     def newNote(self):
         """ Create a new note.
         """
         header = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         note = Note(self, header, '\n')
         self._notes.append(note)
+        self._latest[note.id] = note
         return note
         
-    def save(self):
-        with open(self._filename, 'wb') as f:
-            for note in self._notes:
-                fullheader = '\n---- %s\n' % note._header 
-                f.write(fullheader.encode('utf-8'))
-                f.write(note.text.encode('utf-8'))
+    def save(self, note=None):
+        """ Save the notes to file. In append-only mode, and if a note is
+        given, only that note is appended to the file. In background mode,
+        this only schedules the write.
+        """
+        full = not (self.appendOnly and note is not None)
+        notes = self._notes if full else [note]
+        if full:
+            self._latest = {n.id: n for n in latestVersions(notes)}
+        else:
+            self._latest[note.id] = note
+        # Snapshot what to write; notes that have not been decoded are
+        # written from their raw bytes.
+        entries = [(note, note._header, note._text, note._raw) for note in notes]
+        if self._writer is None:
+            self._write(entries, full)
+        else:
+            self._writer.schedule(entries, full)
+    
+    def flush(self):
+        """ Wait until all saved notes have been written to file.
+        """
+        if self._writer is not None:
+            self._writer.flush()
+    
+    def close(self):
+        """ Flush and stop writing in the background.
+        """
+        if self._writer is not None:
+            self._writer.close()
+    
+    def _write(self, entries, full):
+        # Write the given snapshot, either replacing the file or appended.
+        # This is called from the worker thread in background mode.
+        if not full:
+            self._append(entries)
+            return
+        fingerprints = {}
+        pos = 0
+        tempname = self._filename + '.tmp'
+        with open(tempname, 'wb') as f:
+            for note, header, text, raw in entries:
+                fullheader = ('\n---- %s\n' % header).encode('utf-8')
+                text = entryText(text, raw).encode('utf-8')
+                f.write(fullheader)
+                f.write(text)
+                pos = self._setWritten(note, header, pos, fullheader, text, fingerprints)
+        os.replace(tempname, self._filename)
         self._modtime = os.path.getmtime(self._filename)
-
+        self._size = pos
+        self._fingerprints = fingerprints
+        self._nentries = len(entries)
+    
+    def _append(self, entries):
+        # If the file was changed externally, it must still be reloaded
+        changedBefore = self._modtime != os.path.getmtime(self._filename)
+        chunks = []
+        for note, header, text, raw in entries:
+            chunks.append(('\n---- %s\n' % header).encode('utf-8'))
+            chunks.append(entryText(text, raw).encode('utf-8'))
+        with open(self._filename, 'ab') as f:
+            pos = f.seek(0, 2)
+            f.write(b''.join(chunks))
+        for (note, header, text, raw), fullheader, text in zip(entries, chunks[::2], chunks[1::2]):
+            pos = self._setWritten(note, header, pos, fullheader, text, self._fingerprints)
+        self._nentries += len(entries)
+        if not changedBefore:
+            self._modtime = os.path.getmtime(self._filename)
+            self._size = pos
+    
+    def _setWritten(self, note, header, pos, fullheader, text, fingerprints):
+        # Keep track of where the (stripped) text of a written note is
+        pos += len(fullheader)
+        stripped = text.strip(_WHITESPACE)
+        start = pos + len(text) - len(text.lstrip(_WHITESPACE))
+        note._span = start, start + len(stripped)
+        header = header.strip().strip('-')
+        note._fingerprint = fingerprint(header, stripped)
+        fingerprints[note._fingerprint] = note
+        return pos + len(text)
+    
+    def seal(self, filename):
+        """ Move the file to the given filename, and return a sealed
+        proxy for it that takes over the notes. This proxy continues
+        with an empty file.
+        """
+        self.flush()
+        os.replace(self._filename, filename)
+        sealed = FileProxy(filename, self, self._cacheDir, self.collection,
+                           self.appendOnly, sealed=True)
+        sealed._modtime = os.path.getmtime(filename)
+        sealed._size = os.path.getsize(filename)
+        sealed._nentries = self._nentries
+        sealed._notes, sealed._latest = self._notes, self._latest
+        sealed._fingerprints = self._fingerprints
+        for note in self._fingerprints.values():
+            if note is not None and note._fileProxy is self:
+                note._fileProxy = sealed
+        for note in self._notes:
+            note._fileProxy = sealed
+        # Start anew
+        open(self._filename, 'wb').close()
+        self._modtime = os.path.getmtime(self._filename)
+        self._size = 0
+        self._nentries = 0
+        self._notes, self._latest, self._fingerprints = [], {}, {}
+        return sealed
+    
+    def garbage(self):
+        """ Get the number of notes in the file that have been superseded
+        by a later version.
+        """
+        return self._nentries - len(self._notes)
+    
+    def compact(self):
+        """ Rewrite the file, leaving out the versions of notes that have
+        been superseded. Tombstones are kept.
+        """
+        self._notes = latestVersions(self._notes)
+        self.save()
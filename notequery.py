@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" notes.notequery
+This module implements the parsing of the text in the selection box into
+a Query object, which can be run on a collection. Queries are compiled
+once per text, and their results are cached per collection generation,
+so that running the same query again is instant as long as the
+collection has not changed. A query that narrows a cached one (e.g. by
+typing more characters) is answered by filtering the cached result.
+Results are produced lazily, so that the first page of notes can be
+shown without selecting all of them.
+"""
+
+import itertools
+from collections import OrderedDict
+
+from .headercodec import NEVER, parsePeriod
+
+
+PREFIXES = '. % %% %%% ! !! !!! ? ?? ???'.split(' ')
+
+
+def parseSelection(text):
+    """ Parse the text in the selection box. Returns a tuple (prefix,
+    tags, words, since, until, reverse). Since and until are the datetime
+    boundaries of the selected date range (or None), and reverse is True
+    if the oldest notes should come first.
+    """
+    # Get search items
+    items = [i.strip().lower() for i in text.split(' ')]
+    items = [i for i in items if i]
+
+    prefix = ''
+    tags = []
+    words = []
+    since = until = None
+    reverse = False
+
+    # First item can be the prefix
+    if items and items[0] in PREFIXES:
+        prefix = items.pop(0)
+
+    # Next are either words or tags, or dates or the reverse symbol
+    for item in items:
+        if item == '^':
+            reverse = True
+        elif item.startswith(('>', '<')) and parsePeriod(item[1:]):
+            start, end = parsePeriod(item[1:])
+            if item[0] == '>':
+                since = max(since or start, start)
+            else:
+                until = min(until or start, start)
+        elif '..' in item and all(p == '' or parsePeriod(p) for p in item.split('..', 1)):
+            first, last = item.split('..', 1)
+            if first:
+                start = parsePeriod(first)[0]
+                since = max(since or start, start)
+            if last:
+                end = parsePeriod(last)[1]
+                until = min(until or end, end)
+        elif item.startswith('#'):
+            tags.append(item)
+        else:
+            words.append(item)
+
+    # Done
+    return prefix, tags, words, since, until, reverse
+
+
+class Query:
+    """ A compiled query. Use compileQuery() to get one from the text in
+    the selection box. Queries that select the same notes (e.g. with
+    the tags in a different order) have the same key.
+    """
+
+    def __init__(self, text):
+        (self.prefix, tags, words,
+         self.since, self.until, self.reverse) = parseSelection(text)
+        # The order of tags and words does not matter, and neither do duplicates
+        self.tags = tuple(sorted(set(tags)))
+        self.words = tuple(sorted(set(words)))
+        self.key = (self.prefix, self.tags, self.words,
+                    self.since, self.until, self.reverse)
+
+    def __repr__(self):
+        return '<Query %r>' % (self.key, )
+
+    def run(self, collection, ranked=False):
+        """ Get the selected notes from the given collection as a
+        LazyResult, without using the cache.
+        """
+        return LazyResult(collection.iterQuery(self.prefix, self.tags,
+                                               self.words, ranked,
+                                               since=self.since, until=self.until,
+                                               reverse=self.reverse))
+
+    def narrows(self, other):
+        """ Get whether this query selects a subset of the notes selected
+        by the other query, in the same order. This is the case if e.g.
+        a tag or word is added, or characters are added to one. Returns
+        False if the other query selects on prefix only.
+        """
+        if not (other.tags or other.words or other.since or other.until):
+            return False  # Filtering everything is slower than the index
+        if (self.prefix != other.prefix or self.reverse != other.reverse or
+                (other.since and not (self.since and self.since >= other.since)) or
+                (other.until and not (self.until and self.until <= other.until))):
+            return False
+        for tag in other.tags:
+            if tag == '#':
+                if '#' not in self.tags:
+                    return False
+            elif not any(t != '#' and t.startswith(tag) for t in self.tags):
+                return False
+        for word in other.words:
+            if not (any(w.startswith(word) for w in self.words) or
+                    any(t.startswith('#' + word) for t in self.tags)):
+                return False
+        return True
+
+    def filter(self, notes):
+        """ Yield the notes from the given iterable that match this query.
+        The notes are assumed to already have the right prefix.
+        """
+        tags = [t for t in self.tags if t != '#']
+        untagged = '#' in self.tags
+        words = [(w, '#' + w) for w in self.words]
+        since, until = self.since, self.until
+        for note in notes:
+            if since or until:
+                created = note.created
+                if (created == NEVER or (since and created < since) or
+                        (until and created >= until)):
+                    continue
+            noteTags = note.tags
+            if untagged and noteTags:
+                continue
+            if not all(any(t.startswith(tag) for t in noteTags) for tag in tags):
+                continue
+            noteWords = note.words
+            if not all(any(t.startswith(prefixes) for t in noteWords) or
+                       any(t.startswith(prefixes) for t in noteTags)
+                       for prefixes in words):
+                continue
+            yield note
+
+
+class LazyResult:
+    """ The result of a query, which takes notes from an iterator only
+    when they are needed. Notes that have been taken are kept, so the
+    result can be iterated multiple times. Getting its length consumes
+    the whole iterator.
+    """
+
+    def __init__(self, iterable):
+        self._notes = []
+        self._iter = iter(iterable)
+
+    def __repr__(self):
+        more = '' if self._iter is None else '+'
+        return '<LazyResult with %i%s notes>' % (len(self._notes), more)
+
+    def __len__(self):
+        self._fetch(None)
+        return len(self._notes)
+
+    def __bool__(self):
+        return self.hasMore(0)
+
+    def __iter__(self):
+        i = 0
+        while self.hasMore(i):
+            yield self._notes[i]
+            i += 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            self._fetch(None if i.stop is None or i.stop < 0 else i.stop)
+        else:
+            self._fetch(None if i < 0 else i + 1)
+        return self._notes[i]
+
+    def page(self, start, stop):
+        """ Get a list of the notes from index start to stop.
+        """
+        self._fetch(stop)
+        return self._notes[start:stop]
+
+    def hasMore(self, n):
+        """ Get whether the result has more than n notes.
+        """
+        self._fetch(n + 1)
+        return len(self._notes) > n
+
+    def _fetch(self, n):
+        # Take notes from the iterator until we have n (or all if None)
+        if self._iter is not None and (n is None or len(self._notes) < n):
+            if n is None:
+                self._notes.extend(self._iter)
+            else:
+                self._notes.extend(itertools.islice(self._iter, n - len(self._notes)))
+            if n is None or len(self._notes) < n:
+                self._iter = None  # Exhausted
+
+
+_compiled = OrderedDict()  # text -> Query
+
+
+def compileQuery(text, maxsize=256):
+    """ Get the Query for the given text. Recently used queries are
+    not parsed again.
+    """
+    try:
+        query = _compiled[text]
+        _compiled.move_to_end(text)
+    except KeyError:
+        query = _compiled[text] = Query(text)
+        if len(_compiled) > maxsize:
+            _compiled.popitem(False)
+    return query
+
+
+class QueryCache:
+    """ LRU cache for the results of queries on a collection. Results
+    are keyed by the query and the generation of the collection, which
+    changes whenever a note is added, changed or removed.
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.refinements = 0  # Misses that were answered by filtering
+
+    def __len__(self):
+        return len(self._results)
+
+    @property
+    def hitRate(self):
+        """ The fraction of lookups that were found in the cache.
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def run(self, query, collection, ranked=False):
+        """ Get the result of the given query on the given collection.
+        The returned LazyResult is shared.
+        """
+        key = query.key, ranked, collection.generation
+        try:
+            query, result = self._results[key]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._results.move_to_end(key)
+            return result
+        # Results for older generations will not be used again
+        if self._results and next(reversed(self._results))[2] != key[2]:
+            self._results.clear()
+        # Filter the result of the most recent query that this one narrows,
+        # unless that would parse notes that the index keeps lazy.
+        base = None
+        if not ranked and collection.keepsTokens:
+            for (otherKey, otherRanked, generation) in reversed(self._results):
+                other, result = self._results[otherKey, otherRanked, generation]
+                if not otherRanked and query.narrows(other):
+                    base = result
+                    break
+        if base is not None:
+            self.refinements += 1
+            result = LazyResult(query.filter(base))
+        else:
+            result = query.run(collection, ranked)
+        self._results[key] = query, result
+        if len(self._results) > self.maxsize:
+            self._results.popitem(False)
+        return result
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" notes.notewriter
+This module implements a write-behind queue for a file proxy. Saves are
+collected and written by a worker thread, once there have been no new
+saves for a short while (but at most after a maximum delay). Multiple
+saves are thereby coalesced into a single write, and the UI does not
+wait for the disk.
+"""
+
+import time
+import threading
+
+
+# Write when there were no saves for this long (seconds) ...
+WRITE_DELAY = 2.0
+# ... but do not keep saved notes in memory for longer than this
+MAX_WRITE_DELAY = 10.0
+
+
+class NoteWriter:
+    """ Write-behind queue for a FileProxy. The proxy makes a snapshot
+    of what to write (in the main thread), and the writer calls the
+    _write() method of the proxy with it (in the worker thread).
+    """
+
+    def __init__(self, fileProxy, delay=WRITE_DELAY, maxDelay=MAX_WRITE_DELAY):
+        self._fileProxy = fileProxy
+        self.delay = delay
+        self.maxDelay = maxDelay
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self._flushing = False
+        self._writing = False
+        # Pending work: a full snapshot and/or entries to append
+        self._full = None
+        self._appends = []
+        self._firstTime = None  # Time of the oldest unwritten save
+        self._lastTime = None  # Time of the newest save
+        self._seq = 0  # Number of saves scheduled
+        self._done = 0  # Number of saves that have been written
+        self._error = None  # The last error, if the last write failed
+        self._nerrors = 0  # Number of failed writes
+
+    def schedule(self, entries, full):
+        """ Schedule writing the given entries. If full is True, the
+        entries replace the whole file (and any pending work), otherwise
+        they are appended.
+        """
+        with self._cond:
+            if self._closed:
+                self._fileProxy._write(entries, full)
+                return
+            if full:
+                self._full = entries
+                self._appends = []
+            else:
+                self._appends.extend(entries)
+            now = time.monotonic()
+            if self._firstTime is None:
+                self._firstTime = now
+            self._lastTime = now
+            self._seq += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True,
+                                                name='NoteWriter')
+                self._thread.start()
+            self._cond.notify_all()
+
+    def pending(self):
+        """ Get whether there are saves that have not been written yet.
+        """
+        with self._cond:
+            return self._hasWork() or self._writing
+
+    def flush(self):
+        """ Write all pending saves now, and wait for that to finish.
+        If writing fails, the error is raised; the saves are kept, and
+        writing them is tried again later.
+        """
+        with self._cond:
+            target = self._seq
+            if self._done >= target:
+                return
+            nerrors = self._nerrors
+            self._flushing = True
+            self._cond.notify_all()
+            try:
+                while self._done < target:
+                    if self._nerrors > nerrors:
+                        raise self._error
+                    self._cond.wait()
+            finally:
+                self._flushing = False
+
+    def close(self):
+        """ Flush and stop the worker thread. Saves after closing are
+        written directly. If flushing fails, the error is raised, and
+        the writer is not closed.
+        """
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def _hasWork(self):
+        return self._full is not None or bool(self._appends)
+
+    def _run(self):
+        cond = self._cond
+        while True:
+            with cond:
+                # Wait for something to write
+                while not self._hasWork():
+                    if self._closed:
+                        return
+                    cond.wait()
+                # Wait until it has been quiet for a while, or for a flush
+                while not (self._flushing or self._closed):
+                    timeout = min(self._lastTime + self.delay,
+                                  self._firstTime + self.maxDelay) - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    cond.wait(timeout)
+                # Take the work
+                full, appends, seq = self._full, self._appends, self._seq
+                self._full, self._appends = None, []
+                self._firstTime = None
+                self._writing = True
+
+            # Write without holding the lock, so that saving does not block
+            try:
+                if full is not None:
+                    self._fileProxy._write(full, True)
+                    full = None
+                if appends:
+                    self._fileProxy._write(appends, False)
+            except Exception as err:
+                print('Could not save notes to %s: %s' %
+                      (self._fileProxy._filename, err))
+                with cond:
+                    # Try again later, unless there is a newer full write
+                    if self._full is None:
+                        self._full = full
+                        self._appends[:0] = appends
+                    self._lastTime = time.monotonic()
+                    self._firstTime = self._firstTime or self._lastTime
+                    self._writing = False
+                    self._flushing = False  # A flush raises the error
+                    self._error = err
+                    self._nerrors += 1
+                    cond.notify_all()
+                continue
+
+            with cond:
+                self._writing = False
+                self._done = seq
+                self._error = None
+                cond.notify_all()
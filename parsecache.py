@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" notes.parsecache
+This module implements a persistent cache of parsed note files, so that
+files that did not change need not be parsed at startup. There is one
+cache file per note file, which is valid for as long as the size and
+modification time of the note file match. If they do not match, the
+cache is still used if the content hash matches.
+"""
+
+import os
+import marshal
+import hashlib
+
+
+CACHE_VERSION = 5
+
+
+def cacheFilename(cacheDir, filename):
+    """ Get the filename of the cache for the given note file.
+    """
+    key = hashlib.sha1(os.path.normcase(filename).encode('utf-8')).hexdigest()
+    return os.path.join(cacheDir, key[:24] + '.cache')
+
+
+def _loadKey(f):
+    key = marshal.load(f)
+    version, cachedFilename, size, mtime, digest = key
+    if version != (CACHE_VERSION, marshal.version):
+        raise ValueError('Cache version mismatch')
+    return cachedFilename, size, mtime, digest
+
+
+def isCached(cacheDir, filename, size, mtime):
+    """ Quick check whether there is a valid cache for the given note file,
+    given its size and modification time. Only reads the key of the cache.
+    """
+    try:
+        with open(cacheFilename(cacheDir, filename), 'rb') as f:
+            key = _loadKey(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return False
+    return key[:3] == (filename, size, mtime)
+
+
+def loadCache(cacheDir, filename, buffer, mtime):
+    """ Get the cached records for the given note file, with buffer its
+    contents and mtime its modification time. Returns None if there
+    is no valid cache.
+    """
+    try:
+        with open(cacheFilename(cacheDir, filename), 'rb') as f:
+            cachedFilename, size, cachedMtime, digest = _loadKey(f)
+            # Check key
+            if cachedFilename != filename or size != len(buffer):
+                return None
+            elif mtime != cachedMtime and digest != hashlib.sha1(buffer).digest():
+                return None
+            return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def saveCache(cacheDir, filename, buffer, mtime, records):
+    """ Store the records for the given note file, with buffer its
+    contents and mtime its modification time. The records must be
+    serializable with marshal.
+    """
+    key = ((CACHE_VERSION, marshal.version), filename, len(buffer), mtime,
+           hashlib.sha1(buffer).digest())
+    cachefile = cacheFilename(cacheDir, filename)
+    tmpfile = cachefile + '.tmp'
+    try:
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        with open(tmpfile, 'wb') as f:
+            marshal.dump(key, f)
+            marshal.dump(records, f)
+        os.replace(tmpfile, cachefile)
+    except OSError:
+        pass  # A cache is nice to have, but not essential
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" notes.snapshot
+This module implements a binary snapshot of a collection, from which it
+can be loaded without parsing any text. The note files remain the source
+of truth: the snapshot records the modification time of each file, and
+files that changed since the snapshot are loaded as usual.
+
+A snapshot consists of a header followed by a series of sections. Each
+section is a little-endian uint64 with the number of bytes, followed by
+the data (an array written with the array module, or UTF-8 text), and
+padded to a multiple of 8 bytes, so that arrays can be used directly
+from a memory map. Strings are stored as one text section, with an
+array of (character) offsets. The bodies of the notes are stored as
+UTF-8 bytes with an array of byte offsets, so that each body can be
+decoded when it is needed, directly from the memory map. Tags and words
+are stored as ids in a table of tokens (as uint16 if there are few enough
+tokens), and are only turned into sets when a note needs them. Created
+dates are stored as epoch seconds; modified dates are parsed on demand,
+like when loading from text.
+"""
+
+import os
+import sys
+import mmap
+import struct
+from array import array
+
+from .noteproxy import FileProxy, Note, latestVersions, isSegment
+from .headercodec import NEVER, formatCreated, toEpoch, fromEpoch
+
+
+MAGIC = b'NOTESNAP'
+VERSION = 2
+
+_HEADER = struct.Struct('<8sII')  # magic, version, byte order (1 = little)
+
+# Flags per note
+_DELETED = 1
+_PARSED = 2  # Whether the title, tags and words are stored
+
+
+class _Writer:
+    # Write sections to a file
+
+    def __init__(self, f):
+        self._f = f
+
+    def write(self, data):
+        if isinstance(data, array):
+            data = data.tobytes()
+        self._f.write(struct.pack('<Q', len(data)))
+        self._f.write(data)
+        self._f.write(b'\0' * (-len(data) % 8))
+
+    def writeStrings(self, strings):
+        offsets = array('q', [0])
+        for s in strings:
+            offsets.append(offsets[-1] + len(s))
+        self.write(offsets)
+        self.write(''.join(strings).encode('utf-8'))
+
+    def writeFields(self, values, headers):
+        # Values that are (usually) part of the corresponding header are
+        # stored as their position in it, and the others as strings
+        positions = array('i')
+        others = []
+        for value, header in zip(values, headers):
+            start = header.find(value) if value else -1
+            if start >= 0:
+                positions.extend((start, start + len(value)))
+                others.append('')
+            else:
+                positions.extend((-1, -1))
+                others.append(value)
+        self.write(positions)
+        self.writeStrings(others)
+
+    def writeLists(self, lists, typecode='i'):
+        offsets = array('i', [0])
+        values = array(typecode)
+        for values_ in lists:
+            values.extend(values_)
+            offsets.append(len(values))
+        self.write(offsets)
+        self.write(values)
+
+
+class _Reader:
+    # Read sections from a memoryview
+
+    def __init__(self, view, pos):
+        self._view = view
+        self._pos = pos
+
+    def read(self, typecode=None):
+        n, = struct.unpack_from('<Q', self._view, self._pos)
+        data = self._view[self._pos + 8:self._pos + 8 + n]
+        self._pos += 8 + n + (-n % 8)
+        return data if typecode is None else data.cast(typecode)
+
+    def readStrings(self):
+        offsets = self.read('q')
+        text = str(self.read(), 'utf-8')
+        return [text[offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1)]
+
+    def readFields(self, headers):
+        positions = self.read('i').tolist()
+        others = self.readStrings()
+        return [header[positions[2*i]:positions[2*i+1]] if positions[2*i] >= 0 else other
+                for i, (header, other) in enumerate(zip(headers, others))]
+
+    def readLists(self, typecode='i'):
+        # Returns the offsets and the flat array of values; the values of
+        # list i are values[offsets[i]:offsets[i+1]].
+        return self.read('i'), self.read(typecode)
+
+
+def _tokenType(ntokens):
+    # The typecode for token ids
+    return 'H' if ntokens <= 2**16 else 'i'
+
+
+class _Tokens:
+    # The tags, words and counts of the notes in a snapshot, as arrays of
+    # token ids in the memory map. These are turned into sets and a dict
+    # when a note needs them (see Note._tokens).
+
+    def __init__(self, tokens, lengths, tags, words, counts):
+        self._tokens = tokens
+        self._lengths = lengths
+        self._tagOffsets, self._tags = tags
+        self._wordOffsets, self._words = words
+        self._countOffsets, self._counts = counts
+
+    def get(self, i):
+        tokens = self._tokens
+        tags = {tokens[t] for t in self._tags[self._tagOffsets[i]:self._tagOffsets[i+1]]}
+        words = {tokens[t] for t in self._words[self._wordOffsets[i]:self._wordOffsets[i+1]]}
+        c = self._counts[self._countOffsets[i]:self._countOffsets[i+1]].tolist()
+        counts = {tokens[t]: n for t, n in zip(c[::2], c[1::2])}
+        return tags, words, counts, self._lengths[i]
+
+
+def _diskNotes(fileProxy):
+    # The notes of a proxy as they are on disk (like FileProxy._records)
+    for fp, note in fileProxy._fingerprints.items():
+        if note is not None and note._fingerprint == fp and note._fileProxy is fileProxy:
+            yield note
+
+
+def saveSnapshot(collection, filename):
+    """ Write a snapshot of the given collection to the given file. The
+    notes are stored as they are on disk, and the text of all notes is
+    parsed so that the snapshot contains their tags and words.
+    """
+    collection.flush()
+    vocabulary = collection.vocabulary
+    fileProxies = collection._fileProxies
+
+    # Collect the notes of all files
+    notes, fileIndices = [], array('i')
+    for i, fileProxy in enumerate(fileProxies):
+        for note in _diskNotes(fileProxy):
+            notes.append(note)
+            fileIndices.append(i)
+    prefixes = sorted(set(note.prefix for note in notes))
+    prefixCodes = {prefix: i for i, prefix in enumerate(prefixes)}
+
+    # Per note columns
+    created, spans = array('q'), array('q')
+    flags = array('B')
+    codes, lengths = array('B'), array('i')
+    titleSizes, titles, tags, words, counts = array('i'), [], [], [], []
+    bodies, bodyOffsets = [], array('q', [0])
+    tokenId = vocabulary.tokenId
+    for note in notes:
+        if note._raw is not None:
+            body = note._raw.tobytes()
+        else:
+            body = note._text0.strip().encode('utf-8')
+        parsed = note._text is None or note._text == note._text0
+        if parsed:
+            note.tags  # Parse the text, if needed
+        created.append(toEpoch(note._created))
+        spans.extend(note._span)
+        flags.append(note.deleted * _DELETED | parsed * _PARSED)
+        codes.append(prefixCodes[note.prefix])
+        lengths.append(note._length if parsed else 0)
+        # The title is usually the start of the body; store it only if not
+        title = note._title.encode('utf-8') if parsed else b''
+        if body.startswith(title):
+            titleSizes.append(len(title))
+            titles.append('')
+        else:
+            titleSizes.append(-1)
+            titles.append(note._title)
+        tags.append([tokenId(t) for t in note._tags] if parsed else [])
+        words.append([tokenId(w) for w in note._words] if parsed else [])
+        counts.append([x for token, n in note._counts.items()
+                       for x in (tokenId(token), min(n, 2**16 - 1))] if parsed else [])
+        bodies.append(body)
+        bodyOffsets.append(bodyOffsets[-1] + len(body))
+
+    # Write to a temporary file first, so there is never a partial snapshot
+    tokenType = _tokenType(len(vocabulary))
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, sys.byteorder == 'little'))
+        w = _Writer(f)
+        w.writeStrings([p._filename for p in fileProxies])
+        w.write(array('d', [p._modtime for p in fileProxies]))
+        w.write(array('q', [-1 if p._size is None else p._size for p in fileProxies]))
+        w.write(array('q', [p._nentries for p in fileProxies]))
+        w.writeStrings([collection.folder or ''])
+        w.writeStrings([vocabulary.token(i) for i in range(len(vocabulary))])
+        w.writeStrings(prefixes)
+        w.write(fileIndices)
+        w.write(created)
+        w.write(spans)
+        w.write(flags)
+        w.write(codes)
+        w.write(lengths)
+        w.write(b''.join(note._fingerprint for note in notes))
+        headers = [note._header for note in notes]
+        w.writeStrings(headers)
+        w.writeFields([note.id for note in notes], headers)
+        w.writeFields([note._modifiedRaw for note in notes], headers)
+        w.write(titleSizes)
+        w.writeStrings(titles)
+        w.writeLists(tags, tokenType)
+        w.writeLists(words, tokenType)
+        w.writeLists(counts, tokenType)
+        w.write(bodyOffsets)
+        w.write(b''.join(bodies))
+    os.replace(filename + '.tmp', filename)
+
+
+def loadSnapshot(collection, filename):
+    """ Load the notes from the given snapshot into the given (empty)
+    collection. The notes are not checked against the files; call
+    update() on the collection for that. The snapshot is memory mapped,
+    and the text of each note is decoded when it is needed.
+    """
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    magic, version, little = _HEADER.unpack_from(view, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a (supported) notes snapshot: %r' % filename)
+    elif little != (sys.byteorder == 'little'):
+        raise ValueError('Snapshot was written with another byte order.')
+    r = _Reader(view, _HEADER.size)
+
+    filenames = r.readStrings()
+    modtimes = r.read('d')
+    sizes = r.read('q')
+    nentries = r.read('q')
+    folder = r.readStrings()[0]
+    intern = collection.vocabulary.intern
+    tokens = [intern(token) for token in r.readStrings()]
+    prefixes = r.readStrings()
+    fileIndices = r.read('i').tolist()
+    created = r.read('q').tolist()
+    spans = r.read('q').tolist()
+    flags = r.read('B').tolist()
+    codes = r.read('B').tolist()
+    lengths = r.read('i')
+    fingerprints = r.read().tobytes()
+    headers = r.readStrings()
+    ids = r.readFields(headers)
+    modifiedRaws = r.readFields(headers)
+    titleSizes = r.read('i').tolist()
+    titles = r.readStrings()
+    tokenType = _tokenType(len(tokens))
+    getTokens = _Tokens(tokens, lengths, r.readLists(tokenType), r.readLists(tokenType),
+                        r.readLists(tokenType)).get
+    bodyOffsets = r.read('q').tolist()
+    bodies = r.read()
+
+    # Create the file proxies
+    collection.folder = folder or None
+    mainProxy = None
+    for i, name in enumerate(filenames):
+        fileProxy = FileProxy(name, mainProxy, collection._cacheDir, collection,
+                              collection._appendOnly, collection._background,
+                              mainProxy is not None and isSegment(name))
+        fileProxy._modtime = modtimes[i]
+        fileProxy._size = None if sizes[i] < 0 else sizes[i]
+        fileProxy._nentries = nentries[i]
+        collection._fileProxies.append(fileProxy)
+        mainProxy = mainProxy or fileProxy
+
+    # Create the notes, without parsing anything
+    fileProxies = collection._fileProxies
+    notesPerFile = [[] for name in filenames]
+    createdStrs = {toEpoch(NEVER): (NEVER, '')}
+    for i, (fileIndex, c, flag, code, header, id, modifiedRaw) in enumerate(zip(
+            fileIndices, created, flags, codes, headers, ids, modifiedRaws)):
+        fileProxy = fileProxies[fileIndex]
+        createdStr = createdStrs.get(c)
+        if createdStr is None:
+            dt = fromEpoch(c)
+            createdStr = createdStrs[c] = dt, formatCreated(dt)
+        fields = (id, ) + createdStr + (modifiedRaw, bool(flag & _DELETED))
+        start, end = bodyOffsets[i], bodyOffsets[i+1]
+        title = None
+        if flag & _PARSED:
+            title = titles[i]
+            if titleSizes[i] >= 0:
+                title = str(bodies[start:start + titleSizes[i]], 'utf-8')
+        parsed = prefixes[code], title, None, None, None, 0
+        if start < end:
+            note = Note(fileProxy, header, None, fields=fields,
+                        raw=bodies[start:end], parsed=parsed)
+        else:
+            note = Note(fileProxy, header, '\n', fields=fields, parsed=parsed)
+        if title is not None:
+            note._tokens = getTokens, i  # The tokens are set when needed
+        note._span = spans[2*i], spans[2*i+1]
+        note._fingerprint = fp = fingerprints[20*i:20*i+20]
+        fileProxy._fingerprints[fp] = note
+        notesPerFile[fileIndex].append(note)
+
+    # Select the latest version of each note
+    owners = collection._owners
+    for fileProxy, notes in zip(fileProxies, notesPerFile):
+        fileProxy._notes = latestVersions(notes)
+        fileProxy._latest = {note.id: note for note in fileProxy._notes}
+        for id in fileProxy._latest:
+            owners.setdefault(id, []).append(fileProxy)
+    collection._selectVersions(set(ids))
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" notes.sqlindex
+This module implements an index for the tags and words of the notes in a
+collection on top of SQLite, using an FTS5 table. It has the same
+interface as the InvertedIndex of the noteindex module, but the terms
+are kept in the database instead of in Python objects, and notes are
+indexed without caching their tags and words on the note. This keeps
+memory use bounded for very large collections. If the database is a
+file (e.g. in the cache dir), it is kept between sessions, and notes
+that did not change are not indexed again. Use NoteCollection(index=
+'sqlite') to use it instead of the (default) in-memory index.
+"""
+
+import os
+import heapq
+import hashlib
+import sqlite3
+
+from .noteproxy import parseText, entryText
+from .noteindex import MAXCHAR
+from .headercodec import toEpoch
+
+
+INDEX_VERSION = 2
+
+# The size of the page cache of SQLite, in KiB
+CACHE_SIZE = 16 * 1024
+
+# Terms consist of alphanumeric characters, and tags start with '#'
+_SCHEMA = """
+CREATE TABLE notes (id TEXT PRIMARY KEY, fingerprint BLOB, prefix TEXT,
+                    created INTEGER, modified TEXT, tagged INTEGER);
+CREATE VIRTUAL TABLE fts USING fts5(terms, text UNINDEXED, prefix='2 3',
+    tokenize="unicode61 remove_diacritics 0 tokenchars '#'");
+CREATE VIRTUAL TABLE vocab USING fts5vocab(fts, row);
+"""
+
+
+def indexFilename(cacheDir, filename):
+    """ Get the filename of the index database for the collection with
+    the given (main) note file.
+    """
+    key = hashlib.sha1(os.path.normcase(filename).encode('utf-8')).hexdigest()
+    return os.path.join(cacheDir, key[:24] + '.sqlite')
+
+
+def _isTermPrefix(prefix):
+    # Whether any term can start with the given prefix
+    return (prefix.isalnum() or
+            (prefix.startswith('#') and (prefix == '#' or prefix[1:].isalnum())))
+
+
+def _match(*prefixes):
+    # A query that matches the terms that start with any of the given
+    # prefixes, or None if no term can.
+    items = ['"%s"*' % prefix for prefix in prefixes if _isTermPrefix(prefix)]
+    return '(%s)' % ' OR '.join(items) if items else None
+
+
+class SqlIndex:
+    """ Index that maps tags and words to note ids, stored in an SQLite
+    database with the given filename (in memory by default). Like the
+    InvertedIndex, it is built on first use, and kept up to date via
+    add() and remove(). Call commit() after a batch of changes.
+    """
+
+    # Notes are indexed without keeping their tags and words on the note
+    keepsTokens = False
+
+    def __init__(self, filename=':memory:'):
+        self.built = False
+        self._filename = filename
+        self._db = db = sqlite3.connect(filename)
+        db.execute('PRAGMA cache_size = %i' % -CACHE_SIZE)
+        if filename != ':memory:':
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = NORMAL')
+        if db.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+            for table in ('vocab', 'fts', 'notes'):
+                db.execute('DROP TABLE IF EXISTS %s' % table)
+            db.executescript(_SCHEMA)
+            db.execute('PRAGMA user_version = %i' % INDEX_VERSION)
+            db.commit()
+
+    def __len__(self):
+        return self._db.execute('SELECT count(*) FROM notes').fetchone()[0]
+
+    def build(self, notes):
+        """ Build the index for the given notes. Notes that are already
+        in the database and have not changed are not indexed again.
+        """
+        db = self._db
+        stored = dict(db.execute('SELECT id, fingerprint FROM notes'))
+        for note in notes:
+            fp = stored.pop(note.id, None)
+            if fp is None or fp != self._fingerprint(note):
+                self._add(note)
+        for id in stored:
+            self._remove(id)
+        db.commit()
+        self.built = True
+
+    def add(self, note):
+        """ Add or update the terms for the given note. Does nothing if
+        the index is not built.
+        """
+        if self.built:
+            self._add(note)
+
+    def remove(self, id):
+        """ Remove the note with the given id from the index.
+        """
+        if self.built:
+            self._remove(id)
+
+    def commit(self):
+        """ Commit the changes since the last commit.
+        """
+        self._db.commit()
+
+    def close(self):
+        """ Commit the changes and close the database.
+        """
+        self._db.commit()
+        self._db.close()
+
+    def tags(self, ids=None):
+        """ Get the set of all tags in the index, or of the notes with
+        the given ids.
+        """
+        if ids is None:
+            return set(self.expand('#'))
+        db = self._db
+        db.execute('CREATE TEMP TABLE IF NOT EXISTS selected (id TEXT PRIMARY KEY)')
+        db.execute('DELETE FROM selected')
+        db.executemany('INSERT OR IGNORE INTO selected VALUES (?)', ((id, ) for id in ids))
+        rows = db.execute('SELECT fts.terms FROM selected JOIN notes ON notes.id = selected.id '
+                          'JOIN fts ON fts.rowid = notes.rowid WHERE notes.tagged')
+        return {term for terms, in rows for term in terms.split() if term.startswith('#')}
+
+    def expand(self, prefix):
+        """ Get the terms that start with the given prefix.
+        """
+        rows = self._db.execute('SELECT term FROM vocab WHERE term >= ? AND term < ? '
+                                'ORDER BY term', (prefix, prefix + MAXCHAR))
+        return [term for term, in rows]
+
+    def lookup(self, tags, words):
+        """ Get the set of ids of the notes that have all the given tags,
+        and all the given words (either as word or as tag). Tags and words
+        match all terms that they are a prefix of. The tag '#' matches
+        notes that have no tags.
+        """
+        items = [_match(tag) for tag in tags if tag != '#']
+        items += [_match(word, '#' + word) for word in words]
+        untagged = '#' in tags
+        if None in items:
+            return set()  # No term starts with that
+        elif items:
+            query = ('SELECT notes.id FROM fts JOIN notes ON notes.rowid = fts.rowid '
+                     'WHERE fts MATCH ?')
+            args = (' AND '.join(items), )
+            if untagged:
+                query += ' AND notes.tagged = 0'
+        else:
+            query = 'SELECT id FROM notes' + (' WHERE tagged = 0' if untagged else '')
+            args = ()
+        return {id for id, in self._db.execute(query, args)}
+
+    def rank(self, notes, words, limit):
+        """ Get the (at most) limit notes that match the given words best,
+        sorted by their BM25 score (as computed by FTS5). Words match the
+        terms that they are a prefix of. Notes with equal scores keep
+        their order.
+        """
+        items = [_match(word, '#' + word) for word in words]
+        items = [item for item in items if item is not None]
+        scores = {}
+        if items:
+            rows = self._db.execute('SELECT notes.id, bm25(fts) FROM fts JOIN notes '
+                                    'ON notes.rowid = fts.rowid WHERE fts MATCH ?',
+                                    (' OR '.join(items), ))
+            scores = dict(rows)
+        # The score of FTS5 is negative, and lower is better
+        return heapq.nlargest(limit, notes, key=lambda note: -scores.get(note.id, 0.0))
+
+    def _fingerprint(self, note):
+        # The fingerprint of the note on disk, or None if it has been changed
+        if note._fingerprint is None or note._text != note._text0:
+            return None
+        return bytes(note._fingerprint)
+
+    def _add(self, note):
+        # Use the parsed tags and words of the note if it has them, but do
+        # not parse the text via the note, so that it stays lazy.
+        text = entryText(note._text, note._raw)
+        if note._tags is not None:
+            tags, words, counts = note._tags, note._words, note._counts
+        elif note._tokens is not None:
+            getTokens, i = note._tokens  # E.g. from a snapshot
+            tags, words, counts, length = getTokens(i)
+        else:
+            title, tags, words, counts, length = parseText(text)
+        # Repeat terms that occur more than once, for BM25
+        terms = ' '.join(term for term in sorted(tags | words)
+                         for i in range(counts.get(term, 1)))
+        self._remove(note.id)
+        cursor = self._db.execute('INSERT INTO notes VALUES (?, ?, ?, ?, ?, ?)',
+                                  (note.id, self._fingerprint(note), note.prefix,
+                                   toEpoch(note.created), note._modifiedRaw,
+                                   bool(tags)))
+        self._db.execute('INSERT INTO fts (rowid, terms, text) VALUES (?, ?, ?)',
+                         (cursor.lastrowid, terms, text))
+
+    def _remove(self, id):
+        row = self._db.execute('SELECT rowid FROM notes WHERE id = ?', (id, )).fetchone()
+        if row is not None:
+            self._db.execute('DELETE FROM fts WHERE rowid = ?', row)
+            self._db.execute('DELETE FROM notes WHERE rowid = ?', row)
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" Helpers that are shared by the tests.
+"""
+
+
+def writeNotes(filename, notes, mode='wb', modified=None):
+    """ Write notes to the given file. The notes are given as a dict that
+    maps ids (ints, or strings) to texts. Notes with an int id are created
+    on a day of January 2015 that follows from the id, the others on the
+    first. If modified is given, it is the modified time of all notes.
+    """
+    with open(filename, mode) as f:
+        for id, text in notes.items():
+            if isinstance(id, int):
+                header = 'id:%040x, c:2015-01-%02i' % (id, 1 + (id - 1) % 28)
+            else:
+                header = 'id:%s, c:2015-01-01' % id
+            if modified:
+                header += ', m:' + modified
+            f.write(('\n---- %s\n%s\n' % (header, text)).encode('utf-8'))
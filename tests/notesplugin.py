@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" Pytest plugin to test the notes package (see pytest.ini). The
+repository folder is the package, but its __init__ imports the app, and
+thus Qt. Therefore the package is set up without running its __init__,
+and the repository folder is collected as a plain directory.
+"""
+
+import os
+import sys
+import types
+
+import pytest
+
+REPODIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'notes' not in sys.modules:
+    package = types.ModuleType('notes')
+    package.__path__ = [REPODIR]
+    sys.modules['notes'] = package
+
+
+def pytest_collect_directory(path, parent):
+    if str(path) == REPODIR:
+        return pytest.Dir.from_parent(parent, path=path)
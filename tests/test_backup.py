@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" Tests for incremental backups and restoring them.
+"""
+
+from notes import backup
+from notes.notecollection import NoteCollection
+
+from helpers import writeNotes
+
+
+def texts(filename):
+    return {note.id: note.text.strip() for note in NoteCollection(filename)}
+
+
+def test_round_trip(tmp_path):
+    filename = str(tmp_path / 'notes.a.txt')
+    folder = str(tmp_path / 'backup')
+    writeNotes(filename, {1: 'first #a', 2: 'second', 3: 'third #b'})
+    collection = NoteCollection(filename)
+    original = texts(filename)
+    point = backup.backup(collection, folder)
+    assert (point['changed'], point['removed'], point['total']) == (3, [], 3)
+
+    # Only the new and changed notes are written to the next chunk
+    note = collection.find('second')[0]
+    note.setText('second edited')
+    note.save()
+    collection.find('third')[0].delete()
+    note = collection.newNote()
+    note.setText('fourth')
+    note.save()
+    collection.flush()
+    point = backup.backup(collection, folder, 'xz')
+    assert point['chunk'].endswith('.xz')
+    assert (point['changed'], len(point['removed']), point['total']) == (2, 1, 3)
+    point = backup.backup(collection, folder)
+    assert (point['chunk'], point['changed'], point['total']) == (None, 0, 3)
+
+    # Any point can be restored
+    restored = str(tmp_path / 'restored.txt')
+    assert backup.restore(folder, restored, 0) == 3
+    assert texts(restored) == original
+    assert backup.restore(folder, restored) == 3
+    assert texts(restored) == texts(filename)
+    assert sorted(texts(restored).values()) == ['first #a', 'fourth', 'second edited']
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" Tests for the column store, via the queries of a collection.
+"""
+
+from notes.notecollection import NoteCollection
+
+from helpers import writeNotes
+
+
+def test_iterquery_skips_removed_notes(tmp_path):
+    # Few matches among many notes, and many matches
+    for nrare in (3, 400):
+        filename = str(tmp_path / ('notes.%i.txt' % nrare))
+        writeNotes(filename, {i + 1: 'note %i #rare' % i if i < nrare else 'note %i' % i
+                              for i in range(500)})
+        collection = NoteCollection(filename)
+        result = collection.iterQuery('', ['#rare'])
+        first = next(result)
+        # Delete the other matches, and reuse their rows
+        deleted = [n for n in collection if '#rare' in n.tags and n is not first]
+        for note in deleted:
+            note.delete()
+        for i in range(len(deleted)):
+            collection.newNote().setText('brand new %i' % i)
+        rest = list(result)
+        assert None not in rest
+        assert not any(note.text.startswith('brand new') for note in rest)
+        assert not set(rest) & set(deleted)
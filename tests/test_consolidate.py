@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" Tests for consolidating note files.
+"""
+
+import os
+
+from notes import consolidate
+from notes.notecollection import NoteCollection
+
+from helpers import writeNotes
+
+
+def test_runs_are_not_written_to_note_folder(tmp_path, monkeypatch):
+    os.makedirs(str(tmp_path / 'f'))
+    os.makedirs(str(tmp_path / 'cache'))
+    for device in 'ab':
+        writeNotes(str(tmp_path / 'f' / ('notes.%s.txt' % device)),
+                   {'%s%038x' % (device * 2, i): 'note %i' % i for i in range(20)})
+    runs = []
+    writeRun = consolidate._writeRun
+    monkeypatch.setattr(consolidate, 'RUN_SIZE', 8)
+    monkeypatch.setattr(consolidate, '_writeRun',
+                        lambda run, tempdir: runs.append(writeRun(run, tempdir)) or runs[-1])
+    collection = NoteCollection.fromFolder(str(tmp_path / 'f'), 'a',
+                                           cacheDir=str(tmp_path / 'cache'))
+    assert collection.save_consolidated(str(tmp_path / 'f' / 'all.txt')) == 40
+    assert len(runs) == 5
+    assert all(os.path.dirname(r) == str(tmp_path / 'cache') for r in runs)
+    assert sorted(os.listdir(str(tmp_path / 'f'))) == ['all.txt', 'notes.a.txt', 'notes.b.txt']
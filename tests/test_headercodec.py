@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" Tests for the header codec, compared with parsing each format with strptime.
+"""
+
+import datetime
+
+from notes.headercodec import NEVER, decodeHeader, decodeHeaders, decodeModified, encodeHeader
+
+
+FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%Y%m%d']
+
+HEADERS = [
+    'id:1, c:2015-01-02, m:2015-01-03 10:20:30',
+    'id:2, c:2015-1-2, m:2015-01-03 10:20',
+    'id:3, c:20150102, m:2015-01-03',
+    'id:4, c:2015-01-02 10:20:30, m:20150103',
+    'id:5, c:2015-02-30, m:2015-01-03 25:00:00',
+    'id:6, c:, m:',
+    'id:7, c:yesterday, m:10:20',
+    'id:8, m:2015-01-03 10:20:30',
+    '2015-01-02',
+    'id:10, deleted:yes, c:2016-02-29, m:2016-02-29 23:59:59',
+    '',
+]
+
+
+def parseDate(s):
+    # The way the app used to parse dates
+    for fmt in FORMATS:
+        try:
+            return datetime.datetime.strptime(s, fmt)
+        except ValueError:
+            pass
+
+
+def test_same_as_strptime():
+    for header in HEADERS:
+        id, created, createdStr, modified, deleted = decodeHeader(header)
+        # Get the raw dates the old way
+        expected = {'c': '', 'm': ''}
+        for part in header.split(','):
+            key, colon, value = part.partition(':')
+            if key.strip() in ('c', 'm'):
+                expected[key.strip()] = value.strip()
+            elif part and key.strip() not in ('id', 'deleted'):
+                expected['c'] = part.strip()
+        expectedCreated = parseDate(expected['c'])
+        expectedModified = parseDate(expected['m'])
+        if expectedCreated is None:
+            assert (created, createdStr) == (NEVER, '')
+        else:
+            assert (created, createdStr) == (expectedCreated,
+                                             expectedCreated.strftime('%Y-%m-%d'))
+        if expectedModified is None:
+            assert decodeModified(modified, created) == (created, '')
+        else:
+            assert decodeModified(modified, created) == (
+                expectedModified, expectedModified.strftime('%Y-%m-%d %H:%M:%S'))
+    # Decoding all headers at once gives the same
+    assert decodeHeaders(HEADERS) == [decodeHeader(header) for header in HEADERS]
+
+
+def test_round_trip():
+    for deleted in (False, True):
+        header = encodeHeader('abc', '2015-01-02', '2015-01-03 10:20:30', deleted)
+        id, created, createdStr, modified, isDeleted = decodeHeader(header)
+        assert (id, createdStr, isDeleted) == ('abc', '2015-01-02', deleted)
+        assert decodeModified(modified, created)[1] == '2015-01-03 10:20:30'
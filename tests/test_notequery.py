@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" Tests for parsing the selection box and for lazy query results.
+"""
+
+import datetime
+
+from notes.notequery import LazyResult, Query, parseSelection
+
+
+def test_parse_selection():
+    assert parseSelection('') == ('', [], [], None, None, False)
+    assert parseSelection('  !  #Work  Foo ') == ('!', ['#work'], ['foo'], None, None, False)
+    # The prefix only counts as the first item
+    assert parseSelection('foo !') == ('', [], ['foo', '!'], None, None, False)
+    # Periods and the reverse symbol
+    day = datetime.datetime(2015, 3, 1)
+    assert parseSelection('>2015-02 ^')[3:] == (datetime.datetime(2015, 2, 1), None, True)
+    assert parseSelection('<2015-03')[3:] == (None, day, False)
+    assert parseSelection('2015..2015-02')[3:] == (datetime.datetime(2015, 1, 1), day, False)
+    assert parseSelection('2015-01-01..')[3:] == (datetime.datetime(2015, 1, 1), None, False)
+    # Invalid periods are words
+    assert parseSelection('>2015-13 1..2')[2] == ['>2015-13', '1..2']
+
+
+def test_narrows():
+    assert Query('#work foo').narrows(Query('#wo'))
+    assert Query('#work foo').narrows(Query('f'))
+    assert Query('#foo').narrows(Query('fo'))  # Words also match tags
+    assert Query('# foo').narrows(Query('#'))
+    assert Query('foo >2015-02').narrows(Query('foo >2015'))
+    assert not Query('foo').narrows(Query('foo bar'))
+    assert not Query('#work').narrows(Query('#'))
+    assert not Query('! foo').narrows(Query('fo'))
+    assert not Query('foo ^').narrows(Query('fo'))
+    assert not Query('foo').narrows(Query('fo >2015'))
+    # Filtering all notes of a prefix is not faster than the index
+    assert not Query('! foo').narrows(Query('!'))
+
+
+def test_lazy_result():
+    taken = []
+
+    def notes():
+        for i in range(100):
+            taken.append(i)
+            yield i
+
+    result = LazyResult(notes())
+    assert result.page(0, 16) == list(range(16))
+    assert result.hasMore(16) and len(taken) == 17
+    assert result.page(16, 32) == list(range(16, 32))
+    assert len(taken) == 32
+    assert list(result) == list(range(100))
+    assert len(result) == 100 and not result.hasMore(100)
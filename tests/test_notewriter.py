@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" Tests for writing notes in the background.
+"""
+
+import os
+
+import pytest
+
+from notes.notecollection import NoteCollection
+
+from helpers import writeNotes
+
+
+def test_failed_write_is_raised_and_kept(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'notes.a.txt')
+    writeNotes(filename, {1: 'old text'})
+    collection = NoteCollection(filename, background=True)
+    note = list(collection)[0]
+    note.setText('new text')
+    note.save()
+
+    def replace(src, dst):
+        raise OSError('disk full')
+    monkeypatch.setattr(os, 'replace', replace)
+    with pytest.raises(OSError):
+        collection.flush()
+    with pytest.raises(OSError):
+        collection.close()
+
+    # The save is not lost; it is written once writing works again
+    monkeypatch.undo()
+    collection.close()
+    with open(filename, 'rb') as f:
+        assert b'new text' in f.read()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" Tests for the cache of parsed note files.
+"""
+
+import os
+
+from notes import parsecache
+from notes.noteproxy import getPrefix
+from notes.notecollection import NoteCollection
+
+from helpers import writeNotes
+
+
+def test_only_changed_caches_are_written(tmp_path, monkeypatch):
+    cacheDir = str(tmp_path / 'cache')
+    filenames = [str(tmp_path / 'notes.a.txt'), str(tmp_path / 'notes.b.txt')]
+    writeNotes(filenames[0], {i: 'note %i #t%i' % (i, i) for i in range(1, 11)})
+    writeNotes(filenames[1], {i: 'note %i #t%i' % (i, i) for i in range(11, 21)})
+    saved = []
+    saveCache = parsecache.saveCache
+    monkeypatch.setattr(parsecache, 'saveCache',
+                        lambda cacheDir, filename, *args: saved.append(filename) or
+                        saveCache(cacheDir, filename, *args))
+
+    collection = NoteCollection(*filenames, cacheDir=cacheDir)
+    assert sorted(saved) == filenames  # Parsed at startup
+    del saved[:]
+    collection.saveCache()
+    assert saved == []
+    # Parsed tags and words are stored, once
+    collection.allTags()
+    collection.saveCache()
+    assert sorted(saved) == filenames
+    del saved[:]
+    collection.saveCache()
+    assert saved == []
+    # A file that changed is stored when saving the cache, not on update
+    writeNotes(filenames[1], {21: 'note 21'}, 'ab')
+    os.utime(filenames[1], (1, 1))
+    collection.update()
+    assert len(collection) == 21 and saved == []
+    collection.saveCache()
+    assert saved == [filenames[1]]
+    del saved[:]
+
+    collection = NoteCollection(*filenames, cacheDir=cacheDir)
+    collection.saveCache()
+    assert saved == [] and len(collection) == 21
+
+
+def test_unsaved_edits_are_not_cached(tmp_path):
+    cacheDir = str(tmp_path / 'cache')
+    filename = str(tmp_path / 'notes.a.txt')
+    writeNotes(filename, {1: 'plain note #home'})
+    collection = NoteCollection(filename, cacheDir=cacheDir)
+    note = list(collection)[0]
+    note.setText('! edited note #work')
+    assert note.tags == {'#work'}  # Parse the edit
+    collection.saveCache()
+    collection.close()
+
+    collection = NoteCollection(filename, cacheDir=cacheDir)
+    assert [note.prefix for note in collection] == [getPrefix('plain note #home')]
+    assert len(collection.find('#home')) == 1
+    assert len(collection.find('#work')) == 0
+
+
+def test_superseded_versions_are_counted(tmp_path):
+    cacheDir = str(tmp_path / 'cache')
+    filename = str(tmp_path / 'notes.a.txt')
+    writeNotes(filename, {1: 'version 0'})
+    collection = NoteCollection(filename, cacheDir=cacheDir, appendOnly=True)
+    note = list(collection)[0]
+    for i in range(1, 5):
+        note.setText('version %i' % i)
+        note.save(True)
+    assert collection._fileProxies[0].garbage() == 4
+    collection.saveCache()
+    collection.close()
+    # Also when loaded from the cache, so that the file is compacted
+    collection = NoteCollection(filename, cacheDir=cacheDir, appendOnly=True)
+    assert collection._fileProxies[0].garbage() == 4
+    assert collection.compact(0.5)
+    assert collection._fileProxies[0].garbage() == 0
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" Tests for the sealed segments of the file of a device.
+"""
+
+import os
+
+from notes.noteproxy import isSegment, segmentName, segmentNumber
+from notes.notecollection import NoteCollection
+
+from helpers import writeNotes
+
+
+def test_segment_names():
+    assert isSegment(segmentName('/x/notes.host.txt', 1))
+    assert segmentNumber(segmentName('/x/notes.host.txt', 12)) == 12
+    assert isSegment('/x/notes.host.seg0001.txt')
+    assert not isSegment('/x/notes.host.txt')
+    assert not isSegment('/x/notes.host.42.txt')  # A device named like that
+    assert not isSegment('/x/notes.seg0001.txt')  # Idem
+
+
+def test_device_file_with_number_is_checked(tmp_path):
+    os.makedirs(str(tmp_path / 'f'))
+    mainfile = str(tmp_path / 'f' / 'notes.a.txt')
+    other = str(tmp_path / 'f' / 'notes.host.42.txt')
+    writeNotes(mainfile, {1: 'note 1'})
+    writeNotes(other, {2: 'note 2'})
+    collection = NoteCollection.fromFolder(str(tmp_path / 'f'), 'a')
+    assert len(collection) == 2
+    writeNotes(other, {3: 'note 3'}, 'ab')
+    os.utime(other, (1, 1))
+    collection.update()
+    assert len(collection) == 3
+
+
+def test_segment_that_is_still_being_synced(tmp_path):
+    os.makedirs(str(tmp_path / 'f'))
+    mainfile = str(tmp_path / 'f' / 'notes.a.txt')
+    segment = str(tmp_path / 'f' / 'notes.b.seg0001.txt')
+    writeNotes(mainfile, {1: 'note 1'})
+    writeNotes(segment, {2: 'note 2', 3: 'note 3'})
+    collection = NoteCollection.fromFolder(str(tmp_path / 'f'), 'a')
+    assert len(collection) == 3
+    # The rest of the segment arrives, maybe within the same mtime
+    mtime = os.path.getmtime(segment)
+    writeNotes(segment, {4: 'note 4', 5: 'note 5'}, 'ab')
+    os.utime(segment, (mtime, mtime))
+    collection.update([segment])
+    assert len(collection) == 5
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" Tests for saving a collection to a snapshot, and loading it again.
+"""
+
+import os
+
+from notes.notecollection import NoteCollection
+
+from helpers import writeNotes
+
+
+def signature(note):
+    return (note.id, note.prefix, note.title, note.tags, note.words, note._counts,
+            note._length, note.created, note.modifiedStr, note.deleted, note.text,
+            note._header)
+
+
+def test_round_trip(tmp_path):
+    os.makedirs(str(tmp_path / 'f'))
+    writeNotes(str(tmp_path / 'f' / 'notes.a.txt'),
+               {i: '%s note %i #t%i #t%i w%i w%i' % ('!' * (i % 3), i, i % 5, i % 5, i % 7, i)
+                for i in range(1, 40)}, modified='2015-02-01 10:00')
+    writeNotes(str(tmp_path / 'f' / 'notes.b.txt'),
+               {5: '. a newer version #hidden', 50: 'only here'}, modified='2015-02-02')
+    with open(str(tmp_path / 'f' / 'notes.b.txt'), 'ab') as f:
+        f.write('\n---- 2015-03-01\nno id, unicode éè #t1\n'.encode('utf-8'))
+    collection = NoteCollection.fromFolder(str(tmp_path / 'f'), 'a')
+    list(collection)[0].delete()
+    snapshot = str(tmp_path / 'snapshot')
+    collection.saveSnapshot(snapshot)
+
+    loaded = NoteCollection.loadSnapshot(snapshot)
+    assert not any(note._tags is not None for note in loaded)  # Lazy
+    assert not loaded.update()  # The files are known not to have changed
+    assert sorted(signature(note) for note in loaded) == \
+        sorted(signature(note) for note in collection)
+    for text in ['', '! note', '#t1', 'w3 #t2', '. #hidden']:
+        assert ([note.id for note in loaded.find(text)] ==
+                [note.id for note in collection.find(text)])
+    sizes = [p._size for p in loaded._fileProxies]
+    assert sizes == [os.path.getsize(p._filename) for p in loaded._fileProxies]
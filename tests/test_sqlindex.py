@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" Tests for the SQLite index of a collection.
+"""
+
+import sqlite3
+
+from notes.notecollection import NoteCollection
+from notes.sqlindex import indexFilename
+
+from helpers import writeNotes
+
+
+def writeWords(filename, n):
+    writeNotes(filename, {i + 1: 'note w%i w%i #t%i' % (i % 7, i % 13, i % 5)
+                          for i in range(n)})
+
+
+def test_queries_keep_notes_lazy(tmp_path):
+    filename = str(tmp_path / 'notes.a.txt')
+    writeWords(filename, 500)
+    memory = NoteCollection(filename)
+    collection = NoteCollection(filename, index='sqlite')
+    # Typing a query, each narrowing the previous one
+    for text in ['w', 'w1', 'w1 #', 'w1 #t', 'w1 #t2', '! w1']:
+        expected = [note.id for note in memory.find(text)]
+        assert [note.id for note in collection.find(text)] == expected
+    assert memory.queryCache.refinements > 0
+    assert collection.queryCache.refinements == 0
+    assert not any(note._tags is not None for note in collection)
+
+
+def test_changes_are_committed(tmp_path):
+    filename = str(tmp_path / 'notes.a.txt')
+    writeWords(filename, 10)
+    collection = NoteCollection(filename, cacheDir=str(tmp_path), index='sqlite')
+    collection.allTags()  # Build the index
+    note = collection.newNote()
+    note.setText('a new note #fresh')
+    note.save()
+    # Another connection only sees committed changes
+    db = sqlite3.connect(indexFilename(str(tmp_path), filename))
+    assert db.execute('SELECT count(*) FROM notes').fetchone()[0] == 11
+    assert db.execute("SELECT count(*) FROM vocab WHERE term = '#fresh'").fetchone()[0] == 1
+
+
+def test_tags_of_prefix(tmp_path):
+    filename = str(tmp_path / 'notes.a.txt')
+    writeNotes(filename, {1: '! urgent #work', 2: '. hidden #secret', 3: 'plain #home',
+                          4: '!! very #work #later'})
+    for index in ('memory', 'sqlite'):
+        collection = NoteCollection(filename, index=index)
+        assert collection.allTags() == {'#work', '#secret', '#home', '#later'}
+        assert collection.allTags('') == {'#work', '#home', '#later'}
+        assert collection.allTags('!') == {'#work', '#later'}
+        assert collection.allTags('.') == {'#secret'}
+
+
+def test_snapshot_uses_index(tmp_path):
+    filename = str(tmp_path / 'notes.a.txt')
+    writeWords(filename, 50)
+    collection = NoteCollection(filename, cacheDir=str(tmp_path), index='sqlite')
+    collection.saveSnapshot(str(tmp_path / 'snapshot'))
+    expected = len(collection.find('w3 #t1'))
+    collection.close()
+    loaded = NoteCollection.loadSnapshot(str(tmp_path / 'snapshot'), str(tmp_path),
+                                         index='sqlite')
+    assert not loaded.keepsTokens
+    assert loaded.allTags() == {'#t0', '#t1', '#t2', '#t3', '#t4'}
+    assert len(loaded.find('w3 #t1')) == expected > 0
+    loaded.close()
+    db = sqlite3.connect(indexFilename(str(tmp_path), filename))
+    assert db.execute('SELECT count(*) FROM notes').fetchone()[0] == 50
+
+
+def test_edits_are_indexed_when_saved(tmp_path):
+    filename = str(tmp_path / 'notes.a.txt')
+    writeWords(filename, 10)
+    collection = NoteCollection(filename, cacheDir=str(tmp_path), index='sqlite')
+    collection.allTags()  # Build the index
+    assert not any(note._modified is not None for note in collection)
+    db = sqlite3.connect(indexFilename(str(tmp_path), filename))
+    countTerm = "SELECT count(*) FROM vocab WHERE term = ?"
+    # Typing does not touch the index, but queries see the edit
+    note = collection.find('w3')[0]
+    for text in ['note #t', 'note #ty', 'note #typed']:
+        note.setText(text)
+    assert db.execute(countTerm, ('#typed',)).fetchone()[0] == 0
+    note.setText('note #again')
+    assert [n.id for n in collection.find('#again')] == [note.id]
+    # Saving commits the index
+    note.setText('note #typed')
+    note.save()
+    assert db.execute(countTerm, ('#typed',)).fetchone()[0] == 1
+    collection.close()
+    collection.close()
+    db.close()
+    try:
+        collection._index._db.execute('SELECT 1')
+    except sqlite3.ProgrammingError:
+        pass
+    else:
+        assert False, 'index database is not closed'
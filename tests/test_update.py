@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" Tests for updating a collection when its files change on disk.
+"""
+
+import os
+
+from notes.notecollection import NoteCollection
+
+from helpers import writeNotes
+
+
+def test_removed_file(tmp_path):
+    os.makedirs(str(tmp_path / 'f'))
+    for cacheDir in (None, str(tmp_path / 'cache')):
+        mainfile = str(tmp_path / 'f' / 'notes.a.txt')
+        writeNotes(mainfile, {1: 'note 1'})
+        other = str(tmp_path / 'f' / 'notes.b.txt')
+        open(other, 'wb').close()
+        collection = NoteCollection.fromFolder(str(tmp_path / 'f'), 'a', cacheDir=cacheDir)
+        collection.update()
+        os.remove(other)
+        collection.update()
+        collection.update()
+        assert len(collection) == 1
+
+
+def test_rollover(tmp_path):
+    os.makedirs(str(tmp_path / 'f'))
+    mainfile = str(tmp_path / 'f' / 'notes.a.txt')
+    writeNotes(mainfile, {i: 'note %i' % i for i in range(1, 21)})
+    collection = NoteCollection.fromFolder(str(tmp_path / 'f'), 'a')
+    # A small file is not flushed nor rolled over
+    flushed = []
+    fileProxy = collection._fileProxies[0]
+    fileProxy.flush = lambda: flushed.append(True)
+    assert not collection.rollover(10 ** 6)
+    assert not flushed
+    del fileProxy.flush
+    # A large file is sealed as a segment
+    assert collection.rollover(100)
+    segment = str(tmp_path / 'f' / 'notes.a.seg0001.txt')
+    assert os.path.isfile(segment) and os.path.getsize(mainfile) == 0
+    assert len(NoteCollection.fromFolder(str(tmp_path / 'f'), 'a')) == 20
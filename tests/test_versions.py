@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" Tests for selecting the latest version of notes over the note files.
+"""
+
+import os
+
+from notes.notecollection import NoteCollection
+
+from helpers import writeNotes
+
+MODIFIED = '2015-01-02 10:00:00'
+
+
+def test_loaded_version_wins_with_same_time(tmp_path):
+    os.makedirs(str(tmp_path / 'f'))
+    open(str(tmp_path / 'f' / 'notes.a.txt'), 'wb').close()
+    segment = str(tmp_path / 'f' / 'notes.b.seg0001.txt')
+    other = str(tmp_path / 'f' / 'notes.b.txt')
+    writeNotes(segment, {1: 'first'}, modified=MODIFIED)
+    open(other, 'wb').close()
+    collection = NoteCollection.fromFolder(str(tmp_path / 'f'), 'a')
+    assert [note.text.strip() for note in collection] == ['first']
+    # Saved again within the same second, after the file was sealed
+    writeNotes(other, {1: 'second'}, modified=MODIFIED)
+    os.utime(other, (1, 1))
+    changes = collection.update()
+    assert changes.modified == {'%040x' % 1}
+    assert [note.text.strip() for note in collection] == ['second']
+
+
+def test_unsealed_version_wins_with_same_time(tmp_path):
+    os.makedirs(str(tmp_path / 'f'))
+    open(str(tmp_path / 'f' / 'notes.a.txt'), 'wb').close()
+    writeNotes(str(tmp_path / 'f' / 'notes.b.seg0001.txt'), {1: 'first'}, modified=MODIFIED)
+    writeNotes(str(tmp_path / 'f' / 'notes.b.txt'), {1: 'second'}, modified=MODIFIED)
+    collection = NoteCollection.fromFolder(str(tmp_path / 'f'), 'a')
+    assert [note.text.strip() for note in collection] == ['second']
+
+
+def test_tombstone_keeps_date_and_text(tmp_path):
+    filename = str(tmp_path / 'notes.a.txt')
+    writeNotes(filename, {1: '! first line #tag'}, modified=MODIFIED)
+    collection = NoteCollection(filename, appendOnly=True)
+    note = list(collection)[0]
+    note.delete()
+    assert len(collection) == 0
+    with open(filename, 'rb') as f:
+        header, text = f.read().decode('utf-8').split('\n---- ')[-1].split('\n', 1)
+    # Older versions take unknown fields for the created date, unless a c field follows
+    assert header.startswith('id:%040x, deleted:yes, c:2015-01-01, m:' % 1)
+    assert text.strip() == '! first line #tag'
+    assert len(NoteCollection(filename)) == 0
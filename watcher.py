@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013, Almar Klein
+# BSD licensed.
+
+""" notes.watcher
+This module implements watching the notes folder for changes. On Linux,
+inotify is used (via ctypes), so that changes (e.g. by a sync client)
+are noticed right away, and nothing needs to be done while idle. On
+other platforms, or if inotify is not available, the folder is polled.
+"""
+
+import os
+import sys
+import time
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+from qtpy import QtCore
+
+
+# Inotify constants, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# The events that indicate that a file in the folder has new content
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+# Events are collected until there are none for DEBOUNCE ms, but they
+# are delivered at most MAX_DELAY ms after the first one.
+DEBOUNCE = 50
+MAX_DELAY = 250
+
+# Interval for polling, if inotify is not available
+POLL_INTERVAL = 2000
+
+
+class Inotify:
+    """ Minimal wrapper for inotify, using ctypes. Raises OSError if
+    inotify is not available.
+    """
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._paths = {}  # wd -> path
+
+    def fileno(self):
+        return self._fd
+
+    def addWatch(self, path, mask=WATCH_MASK):
+        """ Watch the given path (a folder) for the given events.
+        """
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self._paths[wd] = path
+        return wd
+
+    def read(self):
+        """ Read the available events. Returns a list of (path, mask)
+        tuples, in which path is the full path of the file that the
+        event is about.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return events
+                raise
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, size = _EVENT.unpack_from(data, pos)
+                pos += _EVENT.size
+                name = data[pos:pos + size].rstrip(b'\0')
+                pos += size
+                folder = self._paths.get(wd, '')
+                events.append((os.path.join(folder, os.fsdecode(name)), mask))
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class FolderWatcher(QtCore.QObject):
+    """ Watch a notes folder, and emit the changed signal with a list
+    of the note files that have changed, or with None if it is not known
+    which files changed (when polling).
+    """
+
+    changed = QtCore.Signal(object)
+
+    def __init__(self, folder, parent=None):
+        super().__init__(parent)
+        self._folder = folder
+        self._filenames = set()
+        self._firstEvent = 0
+
+        # Timer to wait for a burst of writes to end
+        self._debounceTimer = QtCore.QTimer(self)
+        self._debounceTimer.setInterval(DEBOUNCE)
+        self._debounceTimer.setSingleShot(True)
+        self._debounceTimer.timeout.connect(self._emitChanged)
+
+        # Use inotify if we can, otherwise poll
+        self._inotify = self._notifier = self._pollTimer = None
+        try:
+            self._inotify = Inotify()
+            self._inotify.addWatch(folder)
+        except OSError as err:
+            print('Polling for changes, because inotify is not available: %s' % err)
+            if self._inotify is not None:
+                self._inotify.close()
+                self._inotify = None
+            self._pollTimer = QtCore.QTimer(self)
+            self._pollTimer.setInterval(POLL_INTERVAL)
+            self._pollTimer.timeout.connect(lambda: self.changed.emit(None))
+            self._pollTimer.start()
+        else:
+            self._notifier = QtCore.QSocketNotifier(self._inotify.fileno(),
+                                                    QtCore.QSocketNotifier.Read, self)
+            self._notifier.activated.connect(self._onActivated)
+
+    def isPolling(self):
+        """ Get whether the folder is polled instead of watched.
+        """
+        return self._pollTimer is not None
+
+    def close(self):
+        """ Stop watching.
+        """
+        if self._notifier is not None:
+            self._notifier.setEnabled(False)
+            self._inotify.close()
+            self._notifier = None
+        if self._pollTimer is not None:
+            self._pollTimer.stop()
+        self._debounceTimer.stop()
+
+    def _onActivated(self, *args):
+        events = self._inotify.read()
+        for path, mask in events:
+            if mask & IN_Q_OVERFLOW:
+                self._filenames.add(None)  # Events were lost, check all
+            elif path.endswith('.txt'):
+                self._filenames.add(os.path.normcase(path))
+        if not self._filenames:
+            return
+        # Restart the debounce timer, unless we've waited long enough
+        now = time.monotonic()
+        if not self._debounceTimer.isActive():
+            self._firstEvent = now
+        if now - self._firstEvent > MAX_DELAY / 1000:
+            self._emitChanged()
+        else:
+            self._debounceTimer.start()
+
+    def _emitChanged(self):
+        self._debounceTimer.stop()
+        filenames, self._filenames = self._filenames, set()
+        if None in filenames:
+            self.changed.emit(None)
+        elif filenames:
+            self.changed.emit(sorted(filenames))